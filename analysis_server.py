@@ -0,0 +1,247 @@
+import json
+import os
+import sys
+import threading
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from functools import partial
+
+import run_advanced_analysis
+
+# --- CONFIGURATION ---
+
+# Number of worker processes running analyses. Each one keeps its own warm NLP models.
+DEFAULT_WORKERS = 2
+
+# Number of analyses allowed to wait for a free worker before requests are turned away.
+DEFAULT_QUEUE_SIZE = 8
+
+# Largest export upload accepted, in bytes.
+MAX_UPLOAD_BYTES = 512 * 1024 * 1024
+
+# Analyses a worker process runs before it is replaced by a fresh one, so caches that
+# grow with every chat (such as the sentiment token table) are released now and then.
+WORKER_MAX_TASKS = 100
+
+# Files and folders of the dashboard that GET requests may read; everything else in the
+# served folder (chat exports, .git, the scripts) is answered with 404.
+DASHBOARD_FILES = {
+    'index.html', 'index2.html', 'script.js', 'snow.js', 'style.css', 'favicon.png',
+    'advanced_analysis.json', 'analysis_results.json', 'valid_word_analysis_by_pos.json'
+}
+DASHBOARD_FOLDERS = {'music'}
+
+# --- WORKER ---
+
+def init_worker():
+    """
+    Runs once in every worker process: loads the NLP models so analyses start warm.
+    """
+    run_advanced_analysis.warm_up()
+
+def find_malformed_message(messages):
+    """
+    Returns the index of the first uploaded message the pipeline cannot read, or None.
+    Messages need a sender_name and an integer timestamp_ms; reactions and attachments
+    must be lists of objects whose actor, reaction and uri are strings if present.
+    """
+    def is_optional_str(value):
+        return value is None or isinstance(value, str)
+
+    for i, msg in enumerate(messages):
+        if not isinstance(msg, dict) or not isinstance(msg.get('sender_name'), str):
+            return i
+        timestamp = msg.get('timestamp_ms')
+        if not isinstance(timestamp, int) or isinstance(timestamp, bool):
+            return i
+        call_duration = msg.get('call_duration')
+        if call_duration is not None and (not isinstance(call_duration, (int, float)) or isinstance(call_duration, bool)):
+            return i
+        for key in ['reactions'] + run_advanced_analysis.MEDIA_KEYS:
+            items = msg.get(key)
+            if items is None:
+                continue
+            if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+                return i
+            fields = ('actor', 'reaction') if key == 'reactions' else ('uri',)
+            if not all(is_optional_str(item.get(field)) for item in items for field in fields):
+                return i
+    return None
+
+def analyze_request(body, path):
+    """
+    Runs the analysis pipeline on an uploaded export (body) or a server-side path.
+    Returns (status, JSON bytes).
+    """
+    if path is not None:
+        try:
+            messages = run_advanced_analysis.load_messages(path)
+        except (KeyError, TypeError, AttributeError):
+            return 400, json.dumps({'error': f"The export at '{path}' contains malformed messages."}).encode('utf-8')
+        if messages is None:
+            return 400, json.dumps({'error': f"Could not read messages from '{path}'."}).encode('utf-8')
+    else:
+        try:
+            data = json.loads(body)
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return 400, json.dumps({'error': 'The upload is not valid JSON.'}).encode('utf-8')
+        messages = data.get('messages') if isinstance(data, dict) else data
+        if not isinstance(messages, list):
+            return 400, json.dumps({'error': 'Expected a list of messages or an export with a "messages" list.'}).encode('utf-8')
+        malformed = find_malformed_message(messages)
+        if malformed is not None:
+            return 400, json.dumps({'error': f"Message {malformed} is malformed: expected an object with a sender_name, an integer timestamp_ms and string reactions and attachment uris."}).encode('utf-8')
+
+    final_output = run_advanced_analysis.run_analysis(messages)
+    return 200, json.dumps(final_output, indent=4).encode('utf-8')
+
+# --- HTTP SERVER ---
+
+def is_dashboard_file(directory, path):
+    """
+    Returns True if path (as translated from a URL) is a dashboard file under directory.
+    The folder itself stands for its index.html. Symlinks are resolved before checking.
+    """
+    root = os.path.realpath(directory)
+    path = os.path.realpath(path)
+    if path == root:
+        path = os.path.join(root, 'index.html')
+    if not os.path.isfile(path) or os.path.commonpath([root, path]) != root:
+        return False
+    relative = os.path.relpath(path, root).split(os.sep)
+    return (len(relative) == 1 and relative[0] in DASHBOARD_FILES) or (len(relative) > 1 and relative[0] in DASHBOARD_FOLDERS)
+
+def resolve_data_path(data_dir, path):
+    """
+    Resolves a ?path= value against data_dir. Returns the real path, or None if it
+    points outside data_dir (including through symlinks or '..').
+    """
+    root = os.path.realpath(data_dir)
+    resolved = os.path.realpath(os.path.join(root, path))
+    return resolved if os.path.commonpath([root, resolved]) == root else None
+
+class AnalysisServer(ThreadingHTTPServer):
+    """
+    HTTP server that queues analyses onto a bounded pool of warm worker processes.
+    """
+
+    def __init__(self, address, directory, workers, queue_size, data_dir=None):
+        super().__init__(address, partial(AnalysisRequestHandler, directory=directory))
+        # Folder that ?path= may read exports from; None turns ?path= off
+        self.data_dir = data_dir
+        # max_tasks_per_child needs Python 3.11+; older versions keep their workers for good
+        recycling = {'max_tasks_per_child': WORKER_MAX_TASKS} if sys.version_info >= (3, 11) else {}
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, **recycling)
+        # Start (and warm up) every worker now rather than on the first requests
+        for future in [self.pool.submit(int) for _ in range(workers)]:
+            future.result()
+        # Analyses running or waiting for a worker; anything beyond this is refused
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.latest_result = None
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(cancel_futures=True)
+
+class AnalysisRequestHandler(SimpleHTTPRequestHandler):
+    """
+    POST /analyze runs an analysis on an uploaded export, or, if the server has a
+    data directory, on the export at ?path=... inside it. GET /advanced_analysis.json
+    serves the latest result; other GETs serve the dashboard files only.
+    """
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/analyze':
+            self.send_json(404, {'error': 'Not found. POST exports to /analyze.'})
+            return
+
+        path = parse_qs(url.query).get('path', [None])[0]
+        length = 0
+        if path is not None:
+            if self.server.data_dir is None:
+                self.send_json(403, {'error': 'Server-side paths are disabled. Start the server with --data-dir to allow them.'})
+                return
+            path = resolve_data_path(self.server.data_dir, path)
+            if path is None:
+                self.send_json(403, {'error': 'The path is outside the data directory.'})
+                return
+        else:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length <= 0:
+                self.send_json(400, {'error': 'Upload an export as the request body, or pass ?path=.'})
+                return
+            if length > MAX_UPLOAD_BYTES:
+                # The body is never read, so the connection cannot be reused
+                self.close_connection = True
+                self.send_json(413, {'error': 'The upload is too large.'})
+                return
+
+        # Take a slot before reading the upload, so only admitted uploads are held in memory
+        if not self.server.slots.acquire(blocking=False):
+            self.close_connection = True
+            self.send_json(503, {'error': 'Too many analyses queued. Please try again later.'})
+            return
+        try:
+            body = self.rfile.read(length) if path is None else None
+            status, result = self.server.pool.submit(analyze_request, body, path).result()
+        except Exception as e:
+            self.send_json(500, {'error': f"Analysis failed: {e}"})
+            return
+        finally:
+            self.server.slots.release()
+
+        if status == 200:
+            self.server.latest_result = result
+        self.send_body(status, result)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/advanced_analysis.json' and self.server.latest_result is not None:
+            self.send_body(200, self.server.latest_result)
+            return
+        super().do_GET()
+
+    def send_head(self):
+        # Used by both GET and HEAD
+        if not is_dashboard_file(self.directory, self.translate_path(self.path)):
+            self.send_error(404, 'File not found')
+            return None
+        return super().send_head()
+
+    def send_json(self, status, data):
+        self.send_body(status, json.dumps(data).encode('utf-8'))
+
+    def send_body(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the advanced analysis over HTTP, keeping the NLP models loaded between requests.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on (default: 8000)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help=f'Number of analysis worker processes (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help=f'Analyses allowed to wait for a worker (default: {DEFAULT_QUEUE_SIZE})')
+    parser.add_argument('--directory', default=os.path.dirname(os.path.abspath(__file__)), help='Folder with the dashboard files to serve (default: this folder)')
+    parser.add_argument('--data-dir', help='Allow POST /analyze?path= for exports inside this folder (default: off, only uploads are accepted)')
+    args = parser.parse_args()
+
+    # Download NLTK data if not already present
+    run_advanced_analysis.ensure_nltk_data()
+
+    server = AnalysisServer((args.host, args.port), args.directory, args.workers, args.queue_size, args.data_dir)
+    print(f"Analysis server listening on http://{args.host}:{args.port} with {args.workers} warm workers.")
+    if args.data_dir:
+        print(f"POST an export to /analyze, or /analyze?path=<export file or folder in {args.data_dir}>.")
+    else:
+        print("POST an export to /analyze.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down...")
+    finally:
+        server.server_close()
@@ -0,0 +1,343 @@
+import itertools
+import re
+import string
+import sys
+import time
+import argparse
+
+import numpy as np
+from vaderSentiment.vaderSentiment import BOOSTER_DICT, C_INCR, N_SCALAR, NEGATE, SPECIAL_CASES, SentimentIntensityAnalyzer
+
+# --- BATCH VADER SCORING ---
+# Computes the same compound scores as vaderSentiment's polarity_scores, for many
+# messages at once. Each distinct token is looked up in the lexicon only once, and
+# VADER's negation, booster, caps and "least" rules are applied to the tokens of the
+# whole batch with NumPy instead of word by word in Python.
+
+# Codes of the words VADER's rules look for around a lexicon word
+WORD_CODES = {
+    'no': 1, 'or': 2, 'nor': 2, 'never': 3, 'so': 4, 'this': 4, 'without': 5,
+    'doubt': 6, 'least': 7, 'at': 8, 'very': 8, 'kind': 9, 'of': 10, 'but': 11
+}
+NO, OR_NOR, NEVER, SO_THIS, WITHOUT, DOUBT, LEAST, AT_VERY, KIND, OF, BUT = range(1, 12)
+
+# Multi-word phrases from VADER's special cases and boosters. They are rare, so
+# messages containing the first two words of one are scored by VADER itself.
+RARE_PHRASES = [phrase.split() for phrase in list(SPECIAL_CASES) + list(BOOSTER_DICT) if ' ' in phrase]
+
+# Columns of the token table as NumPy arrays
+TABLE_DTYPES = {
+    'lower_id': np.int64, 'valence': np.float64, 'in_lexicon': bool, 'booster': np.float64,
+    'is_booster': bool, 'is_upper': bool, 'negation': bool, 'code': np.int64
+}
+
+# The token table is emptied before a batch once it holds this many tokens, so a
+# long-lived scorer (e.g. in analysis_server) does not keep every token it has seen.
+MAX_TABLE_TOKENS = 200000
+
+# Put before emoji descriptions while replacing emojis; never part of chat text
+EMOJI_MARKER = '\x00'
+MARKER_AFTER_TEXT = re.compile('(?<=[^ ])' + EMOJI_MARKER)
+
+# Compound scores differing from vaderSentiment by more than this fail the check run by
+# this script (python batch_sentiment.py -i <export>)
+VERIFY_TOLERANCE = 1e-4
+
+# Sentences from vaderSentiment's own examples, checked by this script along with the input
+VERIFY_EXAMPLES = [
+    "VADER is smart, handsome, and funny.",
+    "VADER is very smart, handsome, and funny.",
+    "VADER is VERY SMART, uber handsome, and FRIGGIN FUNNY!!!",
+    "VADER is not smart, handsome, nor funny.",
+    "At least it isn't a horrible book.",
+    "The book was only kind of good.",
+    "The plot was good, but the characters are uncompelling and the dialog is not great.",
+    "Today only kinda sux! But I'll get by, lol",
+    "Make sure you :) or :D today!",
+    "Catch utf-8 emoji such as 💘 and 💋 and 😁",
+    "Not bad at all",
+    "no problem, never so happy, without doubt the best",
+    "that was the least bad option but at least it's not the worst??"
+]
+
+class BatchSentimentScorer:
+    """
+    Scores batches of texts with VADER. Tokens are mapped to ids in a table holding
+    their lexicon valence and the flags VADER's rules need, so each distinct token
+    is only examined once per process (until the table reaches MAX_TABLE_TOKENS).
+    """
+
+    def __init__(self, analyzer=None):
+        self.analyzer = analyzer or SentimentIntensityAnalyzer()
+        self.emojis = self.analyzer.emojis
+        # Only single characters are ever replaced by polarity_scores. Descriptions are
+        # marked so the spaces polarity_scores puts before them can be added afterwards.
+        self.emoji_table = str.maketrans({char: EMOJI_MARKER + description for char, description in self.emojis.items() if len(char) == 1})
+
+        self.reset_table()
+
+    def reset_table(self):
+        """
+        Empties the token table.
+        """
+        self.token_ids = {}
+        self.lower_ids = {}
+        self.lowers = []
+        # Rows added since the NumPy arrays were last extended
+        self.pending = {name: [] for name in TABLE_DTYPES}
+        self.table = {name: np.empty(0, dtype=dtype) for name, dtype in TABLE_DTYPES.items()}
+        self.table_size = 0
+        self.rare_prefixes = set()
+        for words in RARE_PHRASES:
+            self.rare_prefixes.add((self.get_lower_id(words[0]), self.get_lower_id(words[1])))
+
+    def get_lower_id(self, lower):
+        lower_id = self.lower_ids.get(lower)
+        if lower_id is None:
+            lower_id = self.lower_ids[lower] = len(self.lower_ids)
+        return lower_id
+
+    def add_token(self, token):
+        """
+        Adds a token (as split from the text) to the token table and returns its id.
+        """
+        # Same as SentiText._strip_punc_if_word: short results were likely emoticons
+        stripped = token.strip(string.punctuation)
+        if len(stripped) <= 2:
+            stripped = token
+        lower = stripped.lower()
+        valence = self.analyzer.lexicon.get(lower)
+
+        self.lowers.append(lower)
+        columns = self.pending
+        columns['lower_id'].append(self.get_lower_id(lower))
+        columns['valence'].append(valence or 0.0)
+        columns['in_lexicon'].append(valence is not None)
+        columns['booster'].append(BOOSTER_DICT.get(lower, 0.0))
+        columns['is_booster'].append(lower in BOOSTER_DICT)
+        columns['is_upper'].append(stripped.isupper())
+        columns['negation'].append(lower in NEGATE or "n't" in lower)
+        columns['code'].append(WORD_CODES.get(lower, 0))
+
+        token_id = self.token_ids[token] = len(self.token_ids)
+        return token_id
+
+    def get_table(self):
+        """
+        Returns the token table as NumPy arrays, appending the pending rows. The arrays
+        grow by doubling, so new tokens do not copy the whole table every batch.
+        """
+        added = len(self.token_ids) - self.table_size
+        if added:
+            size = self.table_size + added
+            for name, values in self.pending.items():
+                column = self.table[name]
+                if size > len(column):
+                    grown = np.empty(max(size, 2 * len(column)), dtype=column.dtype)
+                    grown[:self.table_size] = column[:self.table_size]
+                    column = self.table[name] = grown
+                column[self.table_size:size] = values
+                values.clear()
+            self.table_size = size
+        return self.table
+
+    def replace_emojis(self, text):
+        """
+        Replaces emojis with their descriptions, as polarity_scores does.
+        """
+        if text.isascii() or EMOJI_MARKER in text:
+            return text.strip() if text.isascii() else self.replace_emojis_slowly(text)
+        converted = text.translate(self.emoji_table)
+        if EMOJI_MARKER not in converted:
+            return text.strip()
+        # A space goes before a description unless it follows a space or starts the text
+        return MARKER_AFTER_TEXT.sub(' ', converted).replace(EMOJI_MARKER, '').strip()
+
+    def replace_emojis_slowly(self, text):
+        """
+        Character by character version of replace_emojis, for texts containing EMOJI_MARKER.
+        """
+        converted = []
+        previous_space = True
+        for char in text:
+            if char in self.emojis:
+                if not previous_space:
+                    converted.append(' ')
+                converted.append(self.emojis[char])
+                previous_space = False
+            else:
+                converted.append(char)
+                previous_space = char == ' '
+        return ''.join(converted).strip()
+
+    def compound_scores(self, texts):
+        """
+        Returns the VADER compound score of every text, in order.
+        """
+        count = len(texts)
+        if count == 0:
+            return []
+
+        if len(self.token_ids) >= MAX_TABLE_TOKENS:
+            self.reset_table()
+
+        # Tokenize once, mapping every token to its id in the table
+        converted = [self.replace_emojis(text) for text in texts]
+        tokenized = [text.split() for text in converted]
+        lengths = np.array([len(tokens) for tokens in tokenized], dtype=np.int64)
+        tokens = list(itertools.chain.from_iterable(tokenized))
+        ids = list(map(self.token_ids.get, tokens))
+        for index, token_id in enumerate(ids):
+            if token_id is None:
+                ids[index] = self.token_ids.get(tokens[index])
+                if ids[index] is None:
+                    ids[index] = self.add_token(tokens[index])
+
+        table = self.get_table()
+        ids = np.array(ids, dtype=np.int64)
+        message = np.repeat(np.arange(count), lengths)
+        starts = np.cumsum(lengths) - lengths
+        position = np.arange(len(ids)) - starts[message]
+        message_length = lengths[message]
+
+        in_lexicon = table['in_lexicon'][ids]
+        valence = table['valence'][ids]
+        booster = table['booster'][ids]
+        is_booster = table['is_booster'][ids]
+        is_upper = table['is_upper'][ids]
+        negation = table['negation'][ids]
+        code = table['code'][ids]
+        lower_id = table['lower_id'][ids]
+
+        def previous(values, k):
+            # Value of the token k places earlier; only meaningful where position >= k
+            shifted = np.zeros_like(values)
+            shifted[k:] = values[:-k] if k < len(values) else values[:0]
+            return shifted
+
+        def following(values):
+            # Value of the next token; only meaningful where position < message_length - 1
+            shifted = np.zeros_like(values)
+            shifted[:-1] = values[1:]
+            return shifted
+
+        # Some but not all words in ALL CAPS
+        caps = np.bincount(message, weights=is_upper, minlength=count)
+        cap_differential = ((caps > 0) & (caps < lengths))[message]
+
+        has_next = position < message_length - 1
+        next_code = following(code)
+        scored = in_lexicon & ~is_booster & ~((code == KIND) & has_next & (next_code == OF))
+
+        # "no" before another lexicon word only negates it
+        scores = np.where((code == NO) & has_next & following(in_lexicon), 0.0, valence)
+        codes = {k: previous(code, k) for k in (1, 2, 3)}
+        no_before = ((position >= 1) & (codes[1] == NO)) | ((position >= 2) & (codes[2] == NO)) | ((position >= 3) & (codes[3] == NO) & (codes[1] == OR_NOR))
+        scores = np.where(no_before, valence * N_SCALAR, scores)
+        scores = np.where(is_upper & cap_differential, scores + np.where(scores > 0, C_INCR, -C_INCR), scores)
+
+        # Boosters and negations up to three words before the lexicon word
+        for k, damping in ((1, 1.0), (2, 0.95), (3, 0.9)):
+            applies = (position >= k) & ~previous(in_lexicon, k)
+            scalar = np.where(scores < 0, -previous(booster, k), previous(booster, k))
+            scalar = scalar + np.where(previous(is_booster, k) & previous(is_upper, k) & cap_differential, np.where(scores > 0, C_INCR, -C_INCR), 0.0)
+            scores = np.where(applies, scores + scalar * damping, scores)
+
+            negated = previous(negation, k)
+            if k == 1:
+                factor = np.where(negated, N_SCALAR, 1.0)
+            elif k == 2:
+                never_so = (codes[2] == NEVER) & (codes[1] == SO_THIS)
+                without_doubt = (codes[2] == WITHOUT) & (codes[1] == DOUBT)
+                factor = np.where(never_so, 1.25, np.where(without_doubt, 1.0, np.where(negated, N_SCALAR, 1.0)))
+            else:
+                never_so = ((codes[3] == NEVER) & (codes[2] == SO_THIS)) | (codes[1] == SO_THIS)
+                without_doubt = (codes[3] == WITHOUT) & ((codes[2] == DOUBT) | (codes[1] == DOUBT))
+                factor = np.where(never_so, 1.25, np.where(without_doubt, 1.0, np.where(negated, N_SCALAR, 1.0)))
+            scores = np.where(applies, scores * factor, scores)
+
+        # "least" negates the next word, except in "at least" and "very least"
+        least_before = (position >= 1) & ~previous(in_lexicon, 1) & (codes[1] == LEAST)
+        least_negates = least_before & ((position == 1) | (codes[2] != AT_VERY))
+        scores = np.where(least_negates, scores * N_SCALAR, scores)
+        scores = np.where(scored, scores, 0.0)
+
+        sums = np.bincount(message, weights=scores, minlength=count)
+
+        # Messages needing the rare rules are handled like VADER does, one by one
+        pair_keys = lower_id * len(self.lower_ids) + following(lower_id)
+        rare_keys = np.array([a * len(self.lower_ids) + b for a, b in self.rare_prefixes], dtype=np.int64)
+        rare = np.zeros(count, dtype=bool)
+        rare[message[has_next & np.isin(pair_keys, rare_keys)]] = True
+        has_but = np.zeros(count, dtype=bool)
+        has_but[message[code == BUT]] = True
+
+        # "but" halves what comes before it and boosts what follows; VADER's own check
+        # is used since it has quirks with repeated scores
+        lowers = self.lowers
+        for index in np.flatnonzero(has_but & ~rare):
+            start, end = starts[index], starts[index] + lengths[index]
+            words = [lowers[token_id] for token_id in ids[start:end]]
+            sums[index] = float(sum(SentimentIntensityAnalyzer._but_check(words, scores[start:end].tolist())))
+
+        # Punctuation emphasis, then normalization to [-1, 1]
+        exclamations = np.array([text.count('!') for text in converted])
+        questions = np.array([text.count('?') for text in converted])
+        emphasis = np.minimum(exclamations, 4) * 0.292 + np.where(questions > 3, 0.96, np.where(questions > 1, questions * 0.18, 0))
+        sums = np.where(sums > 0, sums + emphasis, np.where(sums < 0, sums - emphasis, sums))
+        normalized = np.clip(sums / np.sqrt(sums * sums + 15), -1.0, 1.0)
+
+        compounds = [round(score, 4) for score in normalized.tolist()]
+        for index in np.flatnonzero(rare):
+            compounds[index] = self.analyzer.polarity_scores(texts[index])['compound']
+        for index in np.flatnonzero(lengths == 0):
+            compounds[index] = 0.0
+        return compounds
+
+def verify_scores(texts, scorer, tolerance=VERIFY_TOLERANCE):
+    """
+    Compares batch scores with vaderSentiment's polarity_scores.
+    Returns (largest difference, texts differing by more than tolerance).
+    """
+    batch = scorer.compound_scores(texts)
+    largest = 0.0
+    mismatches = []
+    for text, score in zip(texts, batch):
+        expected = scorer.analyzer.polarity_scores(text)['compound']
+        difference = abs(score - expected)
+        largest = max(largest, difference)
+        if difference > tolerance:
+            mismatches.append((text, expected, score))
+    return largest, mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that batch VADER scores match vaderSentiment on a chat export.')
+    parser.add_argument('-i', '--input', default='filtered_messages.json', help='Input JSON file or export folder (default: filtered_messages.json)')
+    parser.add_argument('--tolerance', type=float, default=VERIFY_TOLERANCE, help=f'Largest accepted difference in compound score (default: {VERIFY_TOLERANCE})')
+    args = parser.parse_args()
+
+    from run_advanced_analysis import load_messages, prepare_messages
+
+    messages = load_messages(args.input)
+    if messages is None:
+        sys.exit(1)
+    texts = VERIFY_EXAMPLES + [msg.content for msg in prepare_messages(messages)[0]]
+    scorer = BatchSentimentScorer()
+
+    start = time.perf_counter()
+    scorer.compound_scores(texts)
+    batch_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for text in texts:
+        scorer.analyzer.polarity_scores(text)
+    vader_seconds = time.perf_counter() - start
+
+    largest, mismatches = verify_scores(texts, scorer, args.tolerance)
+    print(f"Scored {len(texts)} texts in {batch_seconds:.2f}s (vaderSentiment: {vader_seconds:.2f}s).")
+    print(f"Largest difference in compound score: {largest:.6f}")
+    for text, expected, score in mismatches[:20]:
+        print(f"  MISMATCH: {expected} vs {score}: {text!r}")
+    if mismatches:
+        print(f"ERROR: {len(mismatches)} texts differ by more than {args.tolerance}.")
+        sys.exit(1)
+    print("All scores match within tolerance.")
@@ -0,0 +1,129 @@
+import os
+import struct
+
+# --- MEDIA HEADER PARSING ---
+# Reads durations of the media attached to chat messages from their container
+# headers only, so large videos and songs never have to be read in full.
+
+# Bitrates (kbps) of MPEG audio layer III, by MPEG version and bitrate index
+MP3_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+
+MP4_EXTENSIONS = ('.mp4', '.m4a', '.m4v', '.mov', '.3gp')
+MP3_EXTENSIONS = ('.mp3',)
+
+def iter_mp4_boxes(f, start, end):
+    """
+    Yields (type, payload start, box end) for the MP4 boxes between start and end.
+    """
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - position
+        if size < header_size:
+            return
+        yield kind, position + header_size, position + size
+        position += size
+
+def get_mp4_duration(path):
+    """
+    Returns the duration in seconds of an MP4/QuickTime file from its 'mvhd' box,
+    or None if it cannot be found.
+    """
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        for kind, payload, box_end in iter_mp4_boxes(f, 0, end):
+            if kind != b'moov':
+                continue
+            for child, child_payload, child_end in iter_mp4_boxes(f, payload, box_end):
+                if child != b'mvhd':
+                    continue
+                f.seek(child_payload)
+                version = f.read(4)[0]
+                if version == 1:
+                    timescale, duration = struct.unpack('>16xIQ', f.read(28))
+                else:
+                    timescale, duration = struct.unpack('>8xII', f.read(16))
+                return duration / timescale if timescale else None
+    return None
+
+def get_mp3_duration(path):
+    """
+    Returns the duration in seconds of an MP3 file from its first frame header:
+    exact for files with a Xing/Info or VBRI header, estimated from the bitrate otherwise.
+    Returns None if no MPEG audio layer III frame is found.
+    """
+    with open(path, 'rb') as f:
+        file_size = f.seek(0, os.SEEK_END)
+        f.seek(0)
+        offset = 0
+        header = f.read(10)
+        if header[:3] == b'ID3' and len(header) == 10:
+            # Skip the ID3v2 tag; its size is stored as a syncsafe integer
+            offset = 10 + ((header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | (header[8] & 0x7f) << 7 | (header[9] & 0x7f))
+            if header[5] & 0x10:
+                offset += 10
+        f.seek(offset)
+        data = f.read(4096)
+
+    for i in range(len(data) - 4):
+        if data[i] != 0xff or data[i + 1] & 0xe0 != 0xe0:
+            continue
+        version_bits = (data[i + 1] >> 3) & 0x03
+        layer_bits = (data[i + 1] >> 1) & 0x03
+        bitrate_index = data[i + 2] >> 4
+        sample_rate_index = (data[i + 2] >> 2) & 0x03
+        if version_bits == 1 or layer_bits != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+            continue # Reserved values or not layer III: keep looking for a real frame
+        version = {3: 1, 2: 2, 0: 2.5}[version_bits]
+        bitrate = MP3_BITRATES[1 if version == 1 else 2][bitrate_index] * 1000
+        sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+        samples_per_frame = 1152 if version == 1 else 576
+        mono = (data[i + 3] >> 6) == 3
+
+        # VBR files carry the total number of frames in a Xing/Info or VBRI header
+        side_info = (17 if mono else 32) if version == 1 else (9 if mono else 17)
+        xing = i + 4 + side_info
+        if data[xing:xing + 4] in (b'Xing', b'Info') and len(data) >= xing + 12:
+            flags = struct.unpack('>I', data[xing + 4:xing + 8])[0]
+            if flags & 0x1:
+                frames = struct.unpack('>I', data[xing + 8:xing + 12])[0]
+                return frames * samples_per_frame / sample_rate
+        vbri = i + 36
+        if data[vbri:vbri + 4] == b'VBRI' and len(data) >= vbri + 18:
+            frames = struct.unpack('>I', data[vbri + 14:vbri + 18])[0]
+            return frames * samples_per_frame / sample_rate
+
+        return (file_size - offset - i) * 8 / bitrate
+    return None
+
+def get_media_duration(path):
+    """
+    Returns the duration in seconds of an MP4 or MP3 file, or None for other
+    files and files whose headers cannot be parsed.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        if extension in MP4_EXTENSIONS:
+            return get_mp4_duration(path)
+        if extension in MP3_EXTENSIONS:
+            return get_mp3_duration(path)
+    except (OSError, struct.error, IndexError):
+        return None
+    return None
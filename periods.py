@@ -0,0 +1,6 @@
+# --- PERIODS ---
+# Calendar periods that messages and day buckets are grouped by. Kept out of
+# run_advanced_analysis so tools like word_index can use them without loading NLTK.
+
+# strftime formats of each period, as accepted by --split and --by
+PERIOD_FORMATS = {'day': '%Y-%m-%d', 'month': '%Y-%m', 'year': '%Y'}
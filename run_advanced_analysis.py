@@ -1,13 +1,31 @@
+import functools
+import glob
+import hashlib
+import heapq
+import importlib.metadata
+import itertools
 import json
+import math
+import os
+import random
 import re
+import sys
+import time
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import nltk
 from nltk.corpus import stopwords
 import emoji
 import textstat
+import numpy as np
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 from datetime import datetime
 import argparse
+from sketches import TDigest, MinHasher, lsh_clusters, HyperLogLog, DistinctSample
+from media_probe import get_media_duration
+from batch_sentiment import BatchSentimentScorer
+from stage_cache import StageCache
+from periods import PERIOD_FORMATS
 
 # --- CONFIGURATION ---
 
@@ -23,106 +41,250 @@ EXCUSE_WORDS = ['sorry', 'late', 'cant', 'wont', 'busy', 'forgot']
 SELF_PRONOUNS = ['i', 'me', 'my', 'mine', 'myself']
 INTERJECTIONS = ['uh', 'um', 'er', 'ah', 'oh', 'wow', 'hmm', 'huh']
 
+# Vocabulary richness: distinct words are counted per month with HyperLogLog sketches
+# of this precision (2^precision registers, about 1.6% error at 12), and the share of
+# words used only once is measured on a sample of this many distinct words.
+# Each month a participant posts in costs one sketch of 2^precision bytes (4 KB at 12),
+# so a participant active for ten years holds about 0.5 MB of sketches; partials store
+# them compressed, which is much less for quiet months.
+VOCABULARY_HLL_PRECISION = 12
+VOCABULARY_SAMPLE_SIZE = 1024
+
+# Gap of inactivity (in hours) after which a new conversation starts.
+CONVERSATION_THRESHOLD_HOURS = 6
+
+# Messages sent between these hours count towards the night owl score.
+NIGHT_START_HOUR = 22
+NIGHT_END_HOUR = 6
+
+# Attachment lists a message can carry, and how many files to inspect at once.
+MEDIA_KEYS = ['photos', 'videos', 'audio_files', 'gifs', 'files']
+MEDIA_WORKERS = 16
+
+# Near-duplicate (copypasta) detection. Messages shorter than the minimum length are
+# never treated as near-duplicates, so short replies like "good morning" are kept.
+NEAR_DUPLICATE_MIN_LENGTH = 40
+NEAR_DUPLICATE_THRESHOLD = 0.8
+# With DROP_NEAR_DUPLICATES, a copy is left out of the analysis only when its sender posted
+# another copy at most NEAR_DUPLICATE_WINDOW_MINUTES later (spam, reposts with a fix).
+# The last copy of such a burst is analyzed, so a "Tomorrow..." reminder corrected to
+# "Today..." a minute later counts as "Today...". Copies by other senders, or posted
+# further apart, are all kept.
+DROP_NEAR_DUPLICATES = True
+NEAR_DUPLICATE_WINDOW_MINUTES = 60
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+COPYPASTA_TOP_N = 10
+
+# Sampled previews (--sample) sample each sender's messages per period of this format,
+# and report 95% confidence intervals.
+SAMPLE_PERIOD_FORMAT = '%Y-%m'
+SAMPLE_SEED = 1
+CONFIDENCE_Z = 1.96
+
+# Stage results are cached here and reused while the input, the configuration they
+# read and the libraries are unchanged. The least recently used are deleted past the limit.
+CACHE_DIR = '.analysis_cache'
+CACHE_MAX_MB = 512
+CACHE_LIBRARIES = ['nltk', 'emoji', 'textstat', 'vaderSentiment', 'numpy']
+STAGE_CACHE_VERSION = 2 # Bump when changing how a stage computes its result
+
+# Longest monologues: how many runs to report per participant, the gap (in minutes)
+# that ends a run even if the same person keeps writing (None to never split runs on
+# time), and how many messages and characters per message of each run to include.
+MONOLOGUE_TOP_K = 1
+MONOLOGUE_MAX_GAP_MINUTES = None
+MONOLOGUE_PREVIEW_MESSAGES = 20
+MONOLOGUE_PREVIEW_CHARS = 280
+
+# Endings of the notices the exporter writes when someone reacts to a message.
+REACTION_NOTICE_SUFFIXES = (' to your message', ' to a message')
+
 # --- MAIN ANALYSIS LOGIC ---
 
-def analyze_messages(input_file, output_file):
+def analyze_messages(input_file, output_file, media_root=None, buckets_file=None, sample_fraction=None, cache=None):
     """
     Main function to run all advanced analysis on the chat messages.
+    Day buckets for later date range reports are saved to buckets_file if given.
+    With sample_fraction, only a quick preview is computed from a sample of the messages.
+    Stage results are reused from and saved to cache (a StageCache) if given.
     """
     print("Starting advanced analysis...")
 
     # Load the filtered messages
-    try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            messages = json.load(f)
-    except FileNotFoundError:
-        print(f"ERROR: Input file not found at '{input_file}'. Please make sure it exists.")
-        return
-    except json.JSONDecodeError:
-        print(f"ERROR: Could not decode JSON from '{input_file}'. The file might be corrupted.")
+    messages = load_messages(input_file)
+    if messages is None:
         return
 
-    # It is recommended to fix encoding issues at the source, in the script that generates the JSON file.
-    # The following code block is a temporary workaround for encoding issues.
-    # It tries to decode the content with utf-8, and if it fails, it tries to fix it.
-    # This is not a robust solution and may corrupt some messages.
-    for message in messages:
-        if 'content' in message and isinstance(message['content'], str):
-            try:
-                # Attempt to see if it's mis-encoded. This is a common pattern for fixing mojibake.
-                message['content'].encode('latin1')
-            except UnicodeEncodeError:
-                # This suggests the string is already proper UTF-8, so we do nothing.
-                pass
-            else:
-                # If latin1 encoding succeeds, it's likely it was double-encoded.
-                try:
-                    message['content'] = message['content'].encode('latin1').decode('utf-8')
-                except (UnicodeEncodeError, UnicodeDecodeError):
-                    pass # Leave as is if the fix fails.
+    if sample_fraction is not None:
+        final_output = run_sampled_analysis(messages, sample_fraction, media_root, stream_greetings=True)
+    else:
+        final_output = run_analysis(messages, media_root, buckets_file, cache, stream_greetings=True)
+
+    # Save the results
+    with open(output_file, 'w', encoding='utf-8') as f:
+        write_analysis(final_output, f)
 
-    # Define a pattern for reaction messages. Note: this is language-dependent.
-    reaction_pattern = re.compile(r"reacted .* to a message", re.IGNORECASE)
+    if cache is not None and cache.directory:
+        print(f"Reused {cache.hits} cached stage results and computed {cache.misses}.")
+    print(f"\nAdvanced analysis complete! Results saved to '{output_file}'.")
+
+def write_analysis(final_output, f):
+    """
+    Writes analysis results to f as indented JSON, like json.dump. A section given as
+    an iterator of (key, value) pairs, such as streamed greetings, is written one
+    item at a time instead of being built in memory first.
+    """
+    f.write('{')
+    for position, (key, value) in enumerate(final_output.items()):
+        f.write(('\n' if position == 0 else ',\n') + '    ' + json.dumps(key) + ': ')
+        if isinstance(value, (dict, list)) or not hasattr(value, '__next__'):
+            f.write(json.dumps(value, indent=4).replace('\n', '\n    '))
+            continue
+        f.write('{')
+        items = 0
+        for item_key, item in value:
+            f.write((',\n' if items else '\n') + '        ' + json.dumps(item_key) + ': ' + json.dumps(item, indent=4).replace('\n', '\n        '))
+            items += 1
+        f.write('\n    }' if items else '}')
+    f.write('\n}' if final_output else '}')
+
+def run_analysis(messages, media_root=None, buckets_file=None, cache=None, stream_greetings=False):
+    """
+    Runs all advanced analysis on loaded messages (records or exported dicts) and
+    returns the results. Attachments are looked up under media_root (the export folder) if given,
+    the day buckets are saved to buckets_file if given, and stage results are reused
+    from cache (a StageCache) if given. With stream_greetings, the greetings are left as
+    an iterator of (sender, greetings) pairs for write_analysis.
+    """
+    cache = cache or StageCache(None, 0)
+    messages, exact_duplicates = remove_exact_duplicates(compact_messages(messages))
+    text_messages, reaction_notices = prepare_messages(messages)
+    # Sort messages by timestamp
+    text_messages.sort(key=lambda x: x.timestamp_ms)
+
+    def detect_copypasta():
+        kept, clusters, near_count = find_copypasta(text_messages)
+        kept_ids = set(map(id, kept))
+        return {'dropped': [i for i, msg in enumerate(text_messages) if id(msg) not in kept_ids], 'clusters': clusters, 'near_duplicates': near_count}
+
+    copypasta = cache.run('copypasta', stage_inputs(
+        hash_messages(text_messages),
+        NEAR_DUPLICATE_MIN_LENGTH=NEAR_DUPLICATE_MIN_LENGTH,
+        NEAR_DUPLICATE_THRESHOLD=NEAR_DUPLICATE_THRESHOLD,
+        DROP_NEAR_DUPLICATES=DROP_NEAR_DUPLICATES,
+        NEAR_DUPLICATE_WINDOW_MINUTES=NEAR_DUPLICATE_WINDOW_MINUTES,
+        MINHASH_PERMUTATIONS=MINHASH_PERMUTATIONS,
+        LSH_BANDS=LSH_BANDS
+    ), detect_copypasta)
+    dropped = set(copypasta['dropped'])
+    text_messages = [msg for i, msg in enumerate(text_messages) if i not in dropped]
+    copypasta_clusters, near_duplicates = copypasta['clusters'], copypasta['near_duplicates']
+    print(f"Removed {exact_duplicates} duplicate and {near_duplicates} near-duplicate messages.")
+    text_hash = hash_messages(text_messages)
 
-    # Filter out non-text and reaction messages
-    text_messages = []
-    for msg in messages:
-        content = msg.get('content')
-        if content and not reaction_pattern.search(content):
-            text_messages.append(msg)
-    
     # Setup participants
-    participants = sorted(list(set(msg['sender_name'] for msg in text_messages)))
+    participants = sorted(list(set(msg.sender_name for msg in text_messages)))
     analysis_by_participant = {name: {} for name in participants}
 
     print(f"Found {len(text_messages)} text messages from {len(participants)} participants.")
 
+    # Count words, emojis, sentiment, night owl messages, questions and mentions per day in one pass
+    daily_buckets = cache.run('daily_buckets', stage_inputs(
+        text_hash,
+        stop_words=sorted(get_stop_words()),
+        INTERJECTIONS=INTERJECTIONS,
+        NIGHT_START_HOUR=NIGHT_START_HOUR,
+        NIGHT_END_HOUR=NIGHT_END_HOUR,
+        timezone=[time.tzname, time.timezone]
+    ), lambda: collect_daily_buckets(text_messages, participants))
+    totals = summarize_buckets(merge_daily_buckets(daily_buckets), participants)
+    if buckets_file:
+        save_daily_buckets(daily_buckets, participants, buckets_file)
+    print(f"Counted messages into {len(daily_buckets)} day buckets.")
+
     # Run all analysis functions
     for name in participants:
-        participant_messages = [msg for msg in text_messages if msg['sender_name'] == name]
+        participant_messages = [msg for msg in text_messages if msg.sender_name == name]
+        participant_hash = hash_messages(participant_messages)
+        participant_totals = totals['analysis_by_participant'][name]
         print(f"\nAnalyzing messages for {name}...")
 
         # 1. Word Frequency Analysis
-        most_common, custom_counts = get_word_frequency(participant_messages, participants)
-        analysis_by_participant[name]['most_common_words'] = most_common
-        analysis_by_participant[name]['custom_word_counts'] = custom_counts
+        analysis_by_participant[name]['most_common_words'] = participant_totals['most_common_words']
+        analysis_by_participant[name]['vocabulary_richness'] = cache.run('vocabulary_richness', stage_inputs(
+            participant_hash,
+            stop_words=sorted(get_stop_words()),
+            participant_names=sorted(get_participant_name_words(participants)),
+            INTERJECTIONS=INTERJECTIONS,
+            VOCABULARY_HLL_PRECISION=VOCABULARY_HLL_PRECISION,
+            VOCABULARY_SAMPLE_SIZE=VOCABULARY_SAMPLE_SIZE,
+            timezone=[time.tzname, time.timezone]
+        ), lambda: get_vocabulary_richness(participant_messages, participants))
+        analysis_by_participant[name]['custom_word_counts'] = participant_totals['custom_word_counts']
         print(f"  - Word frequency analysis complete.")
 
         # 2. Reading Level Analysis
-        analysis_by_participant[name]['reading_level'] = get_reading_level(participant_messages)
+        analysis_by_participant[name]['reading_level'] = cache.run('reading_level', stage_inputs(participant_hash), lambda: get_reading_level(participant_messages))
         print(f"  - Reading level analysis complete.")
 
         # 3. Sentiment Analysis
-        analysis_by_participant[name]['sentiment'] = get_sentiment(participant_messages)
+        analysis_by_participant[name]['sentiment'] = participant_totals['sentiment']
         print(f"  - Sentiment analysis complete.")
         
         # 4. Emoji Analysis
-        analysis_by_participant[name]['emoji_usage'] = get_emoji_usage(participant_messages)
+        analysis_by_participant[name]['emoji_usage'] = participant_totals['emoji_usage']
         print(f"  - Emoji analysis complete.")
 
         # 5. New Analysis Parameters
-        analysis_by_participant[name]['excuse_factor'] = get_excuse_factor(participant_messages)
-        analysis_by_participant[name]['pos_counts'] = get_pos_counts(participant_messages)
-        analysis_by_participant[name]['self_pronoun_counts'] = get_self_pronoun_counts(participant_messages)
+        analysis_by_participant[name]['excuse_factor'] = cache.run('excuse_factor', stage_inputs(participant_hash, EXCUSE_WORDS=EXCUSE_WORDS), lambda: get_excuse_factor(participant_messages))
+        analysis_by_participant[name]['pos_counts'] = cache.run('pos_counts', stage_inputs(participant_hash), lambda: get_pos_counts(participant_messages))
+        analysis_by_participant[name]['self_pronoun_counts'] = cache.run('self_pronoun_counts', stage_inputs(participant_hash, SELF_PRONOUNS=SELF_PRONOUNS), lambda: get_self_pronoun_counts(participant_messages))
         print(f"  - New analysis parameters complete.")
 
     # Run overall analysis
     overall_analysis = {}
-    overall_analysis['top_emojis'] = get_overall_emoji_usage(text_messages)
-    overall_analysis['chat_initiator'] = get_chat_initiator(text_messages)
-    overall_analysis['night_owl_score'] = get_night_owl_score(text_messages, participants)
-    overall_analysis['longest_monologues_per_participant'] = get_longest_monologues_per_participant(text_messages, participants)
-    overall_analysis['question_askers'] = get_question_askers(text_messages, participants)
-    overall_analysis['special_mentions'] = get_special_mentions(text_messages, participants)
+    overall_analysis['top_emojis'] = totals['overall_analysis']['top_emojis']
+    overall_analysis['chat_initiator'] = cache.run('chat_initiator', stage_inputs(text_hash, CONVERSATION_THRESHOLD_HOURS=CONVERSATION_THRESHOLD_HOURS), lambda: get_chat_initiator(text_messages))
+    overall_analysis['night_owl_score'] = totals['overall_analysis']['night_owl_score']
+    overall_analysis['longest_monologues_per_participant'] = cache.run('longest_monologues', stage_inputs(
+        text_hash,
+        MONOLOGUE_TOP_K=MONOLOGUE_TOP_K,
+        MONOLOGUE_MAX_GAP_MINUTES=MONOLOGUE_MAX_GAP_MINUTES,
+        MONOLOGUE_PREVIEW_MESSAGES=MONOLOGUE_PREVIEW_MESSAGES,
+        MONOLOGUE_PREVIEW_CHARS=MONOLOGUE_PREVIEW_CHARS,
+        timezone=[time.tzname, time.timezone]
+    ), lambda: get_longest_monologues_per_participant(text_messages, participants))
+    overall_analysis['question_askers'] = totals['overall_analysis']['question_askers']
+    overall_analysis['special_mentions'] = totals['overall_analysis']['special_mentions']
+    overall_analysis['reply_latency'] = cache.run('reply_latency', stage_inputs(text_hash, CONVERSATION_THRESHOLD_HOURS=CONVERSATION_THRESHOLD_HOURS), lambda: get_reply_latency(text_messages, participants))
+    overall_analysis['reaction_analysis'] = cache.run('reaction_analysis', stage_inputs(
+        hash_messages(messages),
+        participants=participants,
+        REACTION_NOTICE_SUFFIXES=REACTION_NOTICE_SUFFIXES,
+        timezone=[time.tzname, time.timezone]
+    ), lambda: get_reaction_analysis(messages, reaction_notices, participants))
+    # Media results depend on files outside the input, so they are never cached
+    overall_analysis['media_analysis'] = summarize_media_stats(get_media_stats(messages, participants, media_root))
+    overall_analysis['copypasta'] = summarize_copypasta(copypasta_clusters, exact_duplicates, near_duplicates)
     print(f"\nRunning overall analysis...")
     print(f"  - Chat initiator analysis complete.")
     print(f"  - Night owl score analysis complete.")
     print(f"  - Longest monologue analysis complete.")
     print(f"  - Question asker analysis complete.")
     print(f"  - Special mentions analysis complete.")
+    print(f"  - Reply latency analysis complete.")
+    print(f"  - Reaction analysis complete.")
+    print(f"  - Media analysis complete.")
+    print(f"  - Copypasta detection complete.")
 
     # Run inter-participant analysis
-    interaction_data = analyze_interactions(text_messages, participants)
+    interaction_data = cache.run('interaction_analysis', stage_inputs(
+        text_hash,
+        stop_words=sorted(get_stop_words()),
+        INTERJECTIONS=INTERJECTIONS,
+        TOP_N_WORDS=TOP_N_WORDS
+    ), lambda: analyze_interactions(text_messages, participants))
     overall_analysis['interaction_analysis'] = interaction_data
     print(f"  - Interaction analysis complete.")
 
@@ -134,38 +296,357 @@ def analyze_messages(input_file, output_file):
     }
 
     # Generate inter-participant Christmas greetings
-    final_output['inter_participant_christmas_greetings'] = generate_inter_participant_greetings(interaction_data, final_output)
+    greetings = iter_inter_participant_greetings if stream_greetings else generate_inter_participant_greetings
+    final_output['inter_participant_christmas_greetings'] = greetings(interaction_data, final_output)
     print(f"  - Christmas greetings generation complete.")
 
-    # Save the results
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(final_output, f, indent=4)
+    return final_output
 
-    print(f"\nAdvanced analysis complete! Results saved to '{output_file}'.")
+@functools.lru_cache(maxsize=None)
+def get_stop_words():
+    """
+    Returns the English stopwords, loaded once per process.
+    """
+    # stop_words are already downloaded in __main__
+    return frozenset(stopwords.words('english'))
+
+@functools.lru_cache(maxsize=None)
+def get_sentiment_analyzer():
+    """
+    Returns the VADER analyzer, loaded once per process since reading its lexicon is slow.
+    """
+    return SentimentIntensityAnalyzer()
 
+@functools.lru_cache(maxsize=None)
+def get_sentiment_scorer():
+    """
+    Returns the batch VADER scorer, whose token table keeps growing for the whole process.
+    """
+    return BatchSentimentScorer(get_sentiment_analyzer())
 
-def get_word_frequency(messages, participants):
+@functools.lru_cache(maxsize=None)
+def get_code_versions():
     """
-    Calculates the most common words and counts of custom words.
+    Returns the versions of the libraries stage results depend on, and of the stages
+    themselves, for stage cache keys.
     """
-    # stop_words are already downloaded in __main__
-    stop_words = set(stopwords.words('english'))
+    versions = {name: importlib.metadata.version(name) for name in CACHE_LIBRARIES}
+    versions['stages'] = STAGE_CACHE_VERSION
+    return versions
+
+def stage_inputs(input_hash, **config):
+    """
+    Describes what a stage result depends on: its input, the configuration values it
+    reads and the library and code versions.
+    """
+    return {'input': input_hash, 'config': config, 'versions': get_code_versions()}
+
+def hash_messages(messages):
+    """
+    Returns a content hash of message records, in order.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    for msg in messages:
+        digest.update(json.dumps([getattr(msg, slot) for slot in MessageRecord.__slots__], ensure_ascii=False).encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+def ensure_nltk_data():
+    """
+    Downloads the NLTK data used by the analysis if not already present.
+    """
+    try:
+        nltk.data.find('corpora/vader_lexicon')
+    except LookupError:
+        print("Downloading NLTK VADER lexicon...")
+        nltk.download('vader_lexicon')
+    
+    try:
+        nltk.data.find('corpora/stopwords')
+    except LookupError:
+        print("Downloading NLTK stopwords...")
+        nltk.download('stopwords')
+
+    try:
+        nltk.data.find('taggers/averaged_perceptron_tagger')
+    except LookupError:
+        print("Downloading NLTK averaged_perceptron_tagger...")
+        nltk.download('averaged_perceptron_tagger')
     
-    # Create a set of lowercase participant names for efficient filtering
+    try:
+        nltk.data.find('tokenizers/punkt')
+    except LookupError:
+        print("Downloading NLTK punkt tokenizer...")
+        nltk.download('punkt')
+
+def warm_up():
+    """
+    Loads the stopwords, VADER lexicon, POS tagger, tokenizer and emoji tables up front,
+    so that a long-running process does not pay for them on its first analysis.
+    """
+    get_stop_words()
+    get_sentiment_scorer().compound_scores(["warming up the lexicon 🎄"])
+    nltk.pos_tag(nltk.word_tokenize("warming up the tagger"))
+    emoji.emoji_list("warming up 🎄")
+
+
+def load_messages(input_file):
+    """
+    Loads the messages to analyze. Accepts a filtered_messages.json style list, a raw
+    export file ({"messages": [...]}) or an export folder containing message_*.json files.
+    Returns None if the input could not be read.
+    """
+    if os.path.isdir(input_file):
+        paths = sorted(glob.glob(os.path.join(input_file, 'message_*.json')))
+        if not paths:
+            print(f"ERROR: No message_*.json files found in '{input_file}'.")
+            return None
+    else:
+        paths = [input_file]
+
+    messages = []
+    for path in paths:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            print(f"ERROR: Input file not found at '{path}'. Please make sure it exists.")
+            return None
+        except json.JSONDecodeError:
+            print(f"ERROR: Could not decode JSON from '{path}'. The file might be corrupted.")
+            return None
+        # Convert file by file so only one file's worth of raw dicts is alive at a time
+        messages.extend(compact_message(msg) for msg in (data['messages'] if isinstance(data, dict) else data))
+        del data
+    return messages
+
+class MessageRecord:
+    """
+    Compact in-memory form of an exported message, keeping only what the analysis reads.
+    Sender and reactor names are interned, so all messages share one copy of each name.
+    reactions holds (actor, reaction) pairs and attachments holds (kind, uri) pairs,
+    where kind is one of MEDIA_KEYS.
+    """
+    __slots__ = ('sender_name', 'timestamp_ms', 'content', 'reactions', 'attachments', 'has_sticker', 'call_duration')
+
+    def __init__(self, sender_name, timestamp_ms, content=None, reactions=(), attachments=(), has_sticker=False, call_duration=None):
+        self.sender_name = sender_name
+        self.timestamp_ms = timestamp_ms
+        self.content = content
+        self.reactions = reactions
+        self.attachments = attachments
+        self.has_sticker = has_sticker
+        self.call_duration = call_duration
+
+def compact_message(message):
+    """
+    Converts an exported message dict into a MessageRecord, fixing encoding issues on the way.
+    """
+    # It is recommended to fix encoding issues at the source, in the script that generates the JSON file.
+    # This is a temporary workaround for encoding issues (see fix_mojibake).
+    # Reaction emojis are mis-encoded the same way as the message content.
+    content = message.get('content')
+    if isinstance(content, str):
+        content = fix_mojibake(content)
+    else:
+        content = None
+    reactions = tuple(
+        (sys.intern(reaction.get('actor') or ''), sys.intern(fix_mojibake(reaction.get('reaction') or '')))
+        for reaction in message.get('reactions') or ()
+    )
+    attachments = tuple((key, item.get('uri')) for key in MEDIA_KEYS for item in message.get(key) or ())
+    return MessageRecord(
+        sys.intern(message['sender_name']),
+        message['timestamp_ms'],
+        content,
+        reactions,
+        attachments,
+        'sticker' in message,
+        message.get('call_duration')
+    )
+
+def compact_messages(messages):
+    """
+    Converts exported message dicts into MessageRecords; records are passed through.
+    """
+    return [msg if isinstance(msg, MessageRecord) else compact_message(msg) for msg in messages]
+
+def prepare_messages(messages):
+    """
+    Splits message records into text messages and reaction notices.
+    Notices are kept aside for reaction latency.
+    """
+    # Filter out non-text and reaction notice messages
+    text_messages = []
+    reaction_notices = []
+    for msg in messages:
+        content = msg.content
+        if not content:
+            continue
+        notice = parse_reaction_notice(content)
+        if notice is None:
+            text_messages.append(msg)
+        else:
+            reaction_notices.append({'sender_name': msg.sender_name, 'timestamp_ms': msg.timestamp_ms, 'reaction': sys.intern(notice[1])})
+    return text_messages, reaction_notices
+
+def remove_exact_duplicates(messages):
+    """
+    Drops repeated copies of the same message (same sender, timestamp, content and
+    attachments), which appear when exports of several threads are concatenated.
+    Returns the unique messages and the number removed.
+    """
+    seen = set()
+    unique_messages = []
+    for msg in messages:
+        content_hash = hashlib.blake2b(msg.content.encode('utf-8'), digest_size=8).digest() if msg.content is not None else None
+        # Media-only messages have no content, so their attachments tell them apart
+        key = (msg.sender_name, msg.timestamp_ms, content_hash, msg.attachments)
+        if key not in seen:
+            seen.add(key)
+            unique_messages.append(msg)
+    return unique_messages, len(messages) - len(unique_messages)
+
+def get_shingles(content, size=5):
+    """
+    Returns the set of character shingles of a message, ignoring case and spacing.
+    """
+    text = ' '.join(content.lower().split())
+    return {text[i:i + size] for i in range(max(len(text) - size + 1, 1))}
+
+def find_copypasta(text_messages):
+    """
+    Finds clusters of near-identical messages (forwarded copypasta, bot spam) using
+    MinHash signatures and LSH banding, in roughly linear time.
+    Messages must be sorted by timestamp. Returns the messages to analyze (without the
+    repeats if DROP_NEAR_DUPLICATES), the clusters and the number of repeats dropped.
+    A repeat is a copy followed by another copy from the same sender within
+    NEAR_DUPLICATE_WINDOW_MINUTES, so the latest (usually corrected) copy is kept.
+    """
+    candidates = [i for i, msg in enumerate(text_messages) if len(msg.content) >= NEAR_DUPLICATE_MIN_LENGTH]
+    hasher = MinHasher(MINHASH_PERMUTATIONS)
+    signatures = [hasher.signature(get_shingles(text_messages[i].content)) for i in candidates]
+
+    window_ms = NEAR_DUPLICATE_WINDOW_MINUTES * 60 * 1000
+    clusters = []
+    repeats = set()
+    for group in lsh_clusters(signatures, LSH_BANDS, NEAR_DUPLICATE_THRESHOLD):
+        members = [text_messages[candidates[i]] for i in group]
+        last_copy = {}
+        for i, msg in zip(group, members):
+            previous = last_copy.get(msg.sender_name)
+            if previous is not None and msg.timestamp_ms - previous[1] <= window_ms:
+                repeats.add(candidates[previous[0]])
+            last_copy[msg.sender_name] = (i, msg.timestamp_ms)
+        clusters.append({
+            'content': members[0].content,
+            'message_count': len(members),
+            'senders': Counter(msg.sender_name for msg in members),
+            'first_timestamp': members[0].timestamp_ms,
+            'last_timestamp': members[-1].timestamp_ms,
+            'signature': signatures[group[0]]
+        })
+
+    if not DROP_NEAR_DUPLICATES:
+        return text_messages, clusters, 0
+    kept = [msg for i, msg in enumerate(text_messages) if i not in repeats]
+    return kept, clusters, len(repeats)
+
+def merge_copypasta_clusters(clusters):
+    """
+    Merges copypasta clusters found separately (e.g. in different shards) whose
+    representative messages are near-duplicates of each other.
+    """
+    clusters = sorted(clusters, key=lambda c: c['first_timestamp'])
+    merged = []
+    grouped = set()
+    for group in lsh_clusters([c['signature'] for c in clusters], LSH_BANDS, NEAR_DUPLICATE_THRESHOLD):
+        grouped.update(group)
+        members = [clusters[i] for i in group]
+        senders = Counter()
+        for member in members:
+            senders.update(member['senders'])
+        merged.append(dict(members[0], message_count=sum(m['message_count'] for m in members), senders=senders, last_timestamp=max(m['last_timestamp'] for m in members)))
+    merged.extend(cluster for i, cluster in enumerate(clusters) if i not in grouped)
+    return merged
+
+def summarize_copypasta(clusters, exact_duplicates, near_duplicates, top_n=COPYPASTA_TOP_N):
+    """
+    Builds the copypasta section: duplicate counts and the largest clusters.
+    """
+    largest = sorted(clusters, key=lambda c: (c['message_count'], -c['first_timestamp']), reverse=True)[:top_n]
+    return {
+        'exact_duplicates_removed': exact_duplicates,
+        'near_duplicates_removed': near_duplicates,
+        'clusters': [{
+            'content': c['content'],
+            'message_count': c['message_count'],
+            'senders': Counter(c['senders']).most_common(),
+            'first_seen': datetime.fromtimestamp(c['first_timestamp'] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+            'last_seen': datetime.fromtimestamp(c['last_timestamp'] / 1000).strftime('%Y-%m-%d %H:%M:%S')
+        } for c in largest]
+    }
+
+def fix_mojibake(text):
+    """
+    Repairs text that was UTF-8 encoded and then decoded as latin1 by the exporter.
+    This is not a robust solution and may corrupt some messages.
+    """
+    try:
+        # Attempt to see if it's mis-encoded. This is a common pattern for fixing mojibake.
+        text.encode('latin1')
+    except UnicodeEncodeError:
+        # This suggests the string is already proper UTF-8, so we do nothing.
+        return text
+    # If latin1 encoding succeeds, it's likely it was double-encoded.
+    try:
+        return text.encode('latin1').decode('utf-8')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return text # Leave as is if the fix fails.
+
+def parse_reaction_notice(content):
+    """
+    Returns (actor, reaction) if the content is a reaction notice such as
+    "Lance reacted 😆 to your message", otherwise None.
+    Note: this is language-dependent. Only the end of the string is inspected
+    so ordinary messages are rejected without scanning their whole content.
+    """
+    stripped = content.rstrip()
+    if not stripped.endswith(REACTION_NOTICE_SUFFIXES):
+        return None
+    head = stripped[:stripped.rindex(' to ')]
+    actor, separator, reaction = head.partition(' reacted ')
+    if not separator or not actor or not reaction:
+        return None
+    return actor, reaction.strip()
+
+def get_content_words(content, stop_words):
+    """
+    Returns the words of a message used for word frequency: lowercase, without links,
+    stopwords, numbers or interjections. Participant names are removed later.
+    """
+    # Basic cleaning: lowercase, alphanumeric, and remove links
+    content = content.lower()
+    content = re.sub(r'http\S+', '', content) # remove links
+    words = re.findall(r'\b\w+\b', content) # find words
+    return [word for word in words if word not in stop_words and not word.isdigit() and word not in INTERJECTIONS]
+
+def get_participant_name_words(participants):
+    """
+    Returns the set of lowercase words that make up the participant names.
+    """
     participant_names = set()
     for name in participants:
         for word in name.lower().split():
             participant_names.add(word)
+    return participant_names
 
-    all_words = []
-    for message in messages:
-        # Basic cleaning: lowercase, alphanumeric, and remove links
-        content = message.get('content', '').lower()
-        content = re.sub(r'http\S+', '', content) # remove links
-        words = re.findall(r'\b\w+\b', content) # find words
-        all_words.extend([word for word in words if word not in stop_words and not word.isdigit() and word not in participant_names and word not in INTERJECTIONS])
-
-    word_counts = Counter(all_words)
+def summarize_word_counts(word_counts, participants):
+    """
+    Turns raw word counts into the most common words and the custom word counts.
+    """
+    participant_names = get_participant_name_words(participants)
+    word_counts = Counter({word: count for word, count in word_counts.items() if word not in participant_names})
     # Get most common words
     most_common = word_counts.most_common(TOP_N_WORDS)
 
@@ -174,6 +655,124 @@ def get_word_frequency(messages, participants):
     
     return most_common, custom_word_counts
 
+def get_word_frequency(messages, participants):
+    """
+    Calculates the most common words and counts of custom words.
+    """
+    stop_words = get_stop_words()
+
+    word_counts = Counter()
+    for message in messages:
+        word_counts.update(get_content_words(message.content, stop_words))
+
+    return summarize_word_counts(word_counts, participants)
+
+def new_vocabulary():
+    """
+    Returns empty vocabulary sketches: the number of content words, a HyperLogLog
+    sketch of the distinct words of each month, and a sample of the distinct words.
+    The monthly sketches give the new words per month; see VOCABULARY_HLL_PRECISION for their cost.
+    """
+    return {'words': 0, 'months': {}, 'sample': DistinctSample(VOCABULARY_SAMPLE_SIZE)}
+
+def add_vocabulary(vocabulary, words, timestamp_ms):
+    """
+    Adds the content words of one message to vocabulary sketches.
+    """
+    if not words:
+        return
+    vocabulary['words'] += len(words)
+    month = datetime.fromtimestamp(timestamp_ms / 1000).strftime('%Y-%m')
+    sketch = vocabulary['months'].get(month)
+    if sketch is None:
+        sketch = vocabulary['months'][month] = HyperLogLog(VOCABULARY_HLL_PRECISION)
+    for word in words:
+        sketch.add(word)
+        vocabulary['sample'].add(word)
+
+def merge_vocabulary(a, b):
+    """
+    Merges two sets of vocabulary sketches into a.
+    """
+    for month, sketch in b['months'].items():
+        a['months'][month] = a['months'][month].merge(sketch) if month in a['months'] else sketch
+    a['words'] += b['words']
+    a['sample'].merge(b['sample'])
+    return a
+
+def vocabulary_to_dict(vocabulary):
+    """
+    Converts vocabulary sketches to plain dicts for JSON.
+    """
+    return {'words': vocabulary['words'], 'months': {month: sketch.to_dict() for month, sketch in vocabulary['months'].items()}, 'sample': vocabulary['sample'].to_dict()}
+
+def vocabulary_from_dict(data):
+    """
+    Rebuilds vocabulary sketches saved with vocabulary_to_dict.
+    """
+    return {'words': data['words'], 'months': {month: HyperLogLog.from_dict(sketch) for month, sketch in data['months'].items()}, 'sample': DistinctSample.from_dict(data['sample'])}
+
+def summarize_vocabulary(vocabulary):
+    """
+    Computes vocabulary richness from vocabulary sketches: distinct words, type-token
+    ratio, the share of distinct words used only once, and the number of words used
+    for the first time in each month.
+    """
+    seen = HyperLogLog(VOCABULARY_HLL_PRECISION)
+    distinct = 0
+    new_words_per_month = []
+    for month in sorted(vocabulary['months']):
+        seen.merge(vocabulary['months'][month])
+        # Estimates of a growing union can wobble, so they are never allowed to shrink
+        estimate = max(seen.count(), distinct)
+        new_words_per_month.append((month, round(estimate) - round(distinct)))
+        distinct = estimate
+
+    total = vocabulary['words']
+    distinct_words = min(round(distinct), total)
+    sampled = vocabulary['sample'].counts
+    return {
+        'total_words': total,
+        'distinct_words': distinct_words,
+        'type_token_ratio': round(distinct_words / total, 3) if total else 0,
+        'hapax_share': round(sum(1 for count in sampled.values() if count == 1) / len(sampled), 3) if sampled else 0,
+        'new_words_per_month': new_words_per_month
+    }
+
+def get_vocabulary_richness(messages, participants):
+    """
+    Calculates vocabulary richness from the words counted for word frequency,
+    leaving out participant names as get_word_frequency does.
+    """
+    stop_words = get_stop_words()
+    participant_names = get_participant_name_words(participants)
+
+    vocabulary = new_vocabulary()
+    for message in messages:
+        words = [word for word in get_content_words(message.content, stop_words) if word not in participant_names]
+        add_vocabulary(vocabulary, words, message.timestamp_ms)
+
+    return summarize_vocabulary(vocabulary)
+
+def format_reading_level(grade_level, dale_chall):
+    """
+    Builds the reading level entry from a Flesch-Kincaid grade and a Dale-Chall score.
+    """
+    interp = "College Graduate"
+    if grade_level <= 5:
+        interp = "5th Grader"
+    elif grade_level <= 8:
+        interp = "8th Grader"
+    elif grade_level <= 12:
+        interp = "High School Student"
+
+    return {
+        'grade_level': round(grade_level, 2),
+        'dale_chall': round(dale_chall, 2),
+        'interpretation': interp,
+        'age_estimate': round(grade_level + 5)
+    }
+
 def get_reading_level(messages):
     """
     Calculates the Flesch-Kincaid Grade Level for all messages from a user.
@@ -181,7 +780,7 @@ def get_reading_level(messages):
     when applied to informal chat messages.
     """
     # Concatenate all messages into a single block of text
-    full_text = ". ".join([msg.get('content', '') for msg in messages if msg.get('content')])
+    full_text = ". ".join([msg.content for msg in messages if msg.content])
     
     if not full_text.strip():
         return {
@@ -193,50 +792,34 @@ def get_reading_level(messages):
     grade_level = textstat.flesch_kincaid_grade(full_text)
     dale_chall = textstat.dale_chall_readability_score(full_text)
     
-    interp = "College Graduate"
-    if grade_level <= 5:
-        interp = "5th Grader"
-    elif grade_level <= 8:
-        interp = "8th Grader"
-    elif grade_level <= 12:
-        interp = "High School Student"
+    return format_reading_level(grade_level, dale_chall)
 
-    return {
-        'grade_level': round(grade_level, 2),
-        'dale_chall': round(dale_chall, 2),
-        'interpretation': interp,
-        'age_estimate': round(grade_level + 5)
-    }
+def new_sentiment_tally():
+    """
+    Returns an empty sentiment tally, see add_sentiment.
+    """
+    return {'pos': 0, 'neu': 0, 'neg': 0, 'most_positive': ['', 0], 'most_negative': ['', 0]}
 
-def get_sentiment(messages):
+def add_sentiment(tally, content, compound):
     """
-    Performs sentiment analysis on messages.
+    Adds one message with its VADER compound score to a sentiment tally.
     """
-    analyzer = SentimentIntensityAnalyzer()
-    
-    sentiments = {'pos': 0, 'neu': 0, 'neg': 0}
-    count = 0
-    most_positive_message = {'content': '', 'score': 0}
-    most_negative_message = {'content': '', 'score': 0}
-    
-    for message in messages:
-        content = message.get('content', '')
-        if content:
-            vs = analyzer.polarity_scores(content)
-            if vs['compound'] >= 0.05:
-                sentiments['pos'] += 1
-                if vs['compound'] > most_positive_message['score']:
-                    most_positive_message['content'] = content
-                    most_positive_message['score'] = vs['compound']
-            elif vs['compound'] <= -0.05:
-                sentiments['neg'] += 1
-                if vs['compound'] < most_negative_message['score']:
-                    most_negative_message['content'] = content
-                    most_negative_message['score'] = vs['compound']
-            else:
-                sentiments['neu'] += 1
-            count += 1
-            
+    if compound >= 0.05:
+        tally['pos'] += 1
+        if compound > tally['most_positive'][1]:
+            tally['most_positive'] = [content, compound]
+    elif compound <= -0.05:
+        tally['neg'] += 1
+        if compound < tally['most_negative'][1]:
+            tally['most_negative'] = [content, compound]
+    else:
+        tally['neu'] += 1
+
+def summarize_sentiment(tally):
+    """
+    Turns a sentiment tally into percentages and example messages.
+    """
+    count = tally['pos'] + tally['neu'] + tally['neg']
     if count == 0:
         return {
             'positive_percent': 0,
@@ -249,22 +832,34 @@ def get_sentiment(messages):
         }
 
     return {
-        'positive_percent': round((sentiments['pos'] / count) * 100, 2),
-        'neutral_percent': round((sentiments['neu'] / count) * 100, 2),
-        'negative_percent': round((sentiments['neg'] / count) * 100, 2),
+        'positive_percent': round((tally['pos'] / count) * 100, 2),
+        'neutral_percent': round((tally['neu'] / count) * 100, 2),
+        'negative_percent': round((tally['neg'] / count) * 100, 2),
         'sentiment_examples': {
-            'most_positive': most_positive_message['content'],
-            'most_negative': most_negative_message['content']
+            'most_positive': tally['most_positive'][0],
+            'most_negative': tally['most_negative'][0]
         }
     }
 
+def get_sentiment(messages):
+    """
+    Performs sentiment analysis on messages.
+    """
+    contents = [message.content for message in messages if message.content]
+
+    tally = new_sentiment_tally()
+    for content, compound in zip(contents, get_sentiment_scorer().compound_scores(contents)):
+        add_sentiment(tally, content, compound)
+
+    return summarize_sentiment(tally)
+
 def get_emoji_usage(messages, top_n=5):
     """
     Finds the most used emojis for a participant.
     """
     all_emojis = []
     for message in messages:
-        content = message.get('content', '')
+        content = message.content
         # The emoji library is great for this
         emojis_in_message = [emj['emoji'] for emj in emoji.emoji_list(content)]
         all_emojis.extend(emojis_in_message)
@@ -277,7 +872,7 @@ def get_overall_emoji_usage(messages, top_n=5):
     """
     all_emojis = []
     for message in messages:
-        content = message.get('content', '')
+        content = message.content
         emojis_in_message = [emj['emoji'] for emj in emoji.emoji_list(content)]
         all_emojis.extend(emojis_in_message)
         
@@ -289,7 +884,7 @@ def get_excuse_factor(messages):
     """
     all_words = []
     for message in messages:
-        content = message.get('content', '').lower()
+        content = message.content.lower()
         words = re.findall(r'\b\w+\b', content)
         all_words.extend(words)
     
@@ -303,31 +898,36 @@ def get_pos_counts(messages):
     """
     pos_counts = {'adjectives': 0, 'verbs': 0, 'nouns': 0}
     for message in messages:
-        content = message.get('content', '').lower()
-        tokens = nltk.word_tokenize(content)
-        tagged = nltk.pos_tag(tokens)
-        for word, tag in tagged:
-            if tag.startswith('JJ'):
-                pos_counts['adjectives'] += 1
-            elif tag.startswith('VB'):
-                pos_counts['verbs'] += 1
-            elif tag.startswith('NN'):
-                pos_counts['nouns'] += 1
+        add_pos_counts(pos_counts, message.content)
     return pos_counts
 
+def add_pos_counts(pos_counts, content):
+    """
+    Adds the adjectives, verbs, and nouns of one message to pos_counts.
+    """
+    tokens = nltk.word_tokenize(content.lower())
+    tagged = nltk.pos_tag(tokens)
+    for word, tag in tagged:
+        if tag.startswith('JJ'):
+            pos_counts['adjectives'] += 1
+        elif tag.startswith('VB'):
+            pos_counts['verbs'] += 1
+        elif tag.startswith('NN'):
+            pos_counts['nouns'] += 1
+
 def get_self_pronoun_counts(messages):
     """
     Counts the occurrences of self-pronouns.
     """
     pronoun_counts = {pronoun: 0 for pronoun in SELF_PRONOUNS}
     for message in messages:
-        content = message.get('content', '')
+        content = message.content
         for pronoun in SELF_PRONOUNS:
             pronoun_counts[pronoun] += len(re.findall(r'\b' + re.escape(pronoun) + r'\b', content, re.IGNORECASE))
     return pronoun_counts
 
 
-def get_chat_initiator(messages, threshold_hours=6):
+def get_chat_initiator(messages, threshold_hours=CONVERSATION_THRESHOLD_HOURS):
     """
     Determines who starts the most conversations.
     A new conversation is defined as the first message after a period of inactivity.
@@ -337,7 +937,7 @@ def get_chat_initiator(messages, threshold_hours=6):
         return {}
         
     # Sort messages by timestamp
-    messages.sort(key=lambda x: x['timestamp_ms'])
+    messages.sort(key=lambda x: x.timestamp_ms)
     
     initiators = []
     last_timestamp = 0
@@ -345,291 +945,919 @@ def get_chat_initiator(messages, threshold_hours=6):
     for msg in messages:
         # Check for sufficient time gap to consider a new conversation
         # Assuming timestamps are in milliseconds
-        if (last_timestamp != 0) and ((msg['timestamp_ms'] - last_timestamp) / 1000 / 3600 > threshold_hours):
-            initiators.append(msg['sender_name'])
+        if (last_timestamp != 0) and ((msg.timestamp_ms - last_timestamp) / 1000 / 3600 > threshold_hours):
+            initiators.append(msg.sender_name)
         elif last_timestamp == 0: # First message in the entire chat is always an initiator
-            initiators.append(msg['sender_name'])
-        last_timestamp = msg['timestamp_ms']
+            initiators.append(msg.sender_name)
+        last_timestamp = msg.timestamp_ms
         
     return Counter(initiators).most_common()
     
-def get_night_owl_score(messages, participants, night_start=22, night_end=6):
+def collect_reply_latency(messages, participants, threshold_hours=CONVERSATION_THRESHOLD_HOURS):
+    """
+    Collects reply latencies (in seconds) into one t-digest per sender -> responder pair.
+    A reply is the next message by a different person within the same conversation,
+    using the same inactivity threshold as get_chat_initiator. Messages must be sorted.
+    """
+    digests = {sender: {responder: TDigest() for responder in participants if responder != sender} for sender in participants}
+
+    threshold_ms = threshold_hours * 3600 * 1000
+    last_sender = None
+    last_timestamp = 0
+    for msg in messages:
+        sender = msg.sender_name
+        timestamp = msg.timestamp_ms
+        if last_sender is not None and sender != last_sender and timestamp - last_timestamp <= threshold_ms:
+            digests[last_sender][sender].add((timestamp - last_timestamp) / 1000)
+        last_sender = sender
+        last_timestamp = timestamp
+    return digests
+
+def summarize_reply_latency(digests):
+    """
+    Turns the reply latency digests into median, p90 and p99 per pair.
+    """
+    reply_latency = {}
+    for sender, responders in digests.items():
+        reply_latency[sender] = {}
+        for responder, digest in responders.items():
+            reply_latency[sender][responder] = {
+                'replies': digest.count,
+                'median_seconds': round(digest.quantile(0.5), 2) if digest.count else None,
+                'p90_seconds': round(digest.quantile(0.9), 2) if digest.count else None,
+                'p99_seconds': round(digest.quantile(0.99), 2) if digest.count else None
+            }
+    return reply_latency
+
+def get_reply_latency(messages, participants, threshold_hours=CONVERSATION_THRESHOLD_HOURS):
+    """
+    Measures how quickly each participant replies to each other participant.
+    Latencies are kept in t-digests so memory stays bounded per pair no matter how
+    long the chat is.
+    """
+    # Sort messages by timestamp
+    messages.sort(key=lambda x: x.timestamp_ms)
+
+    return summarize_reply_latency(collect_reply_latency(messages, participants, threshold_hours))
+
+def get_night_owl_score(messages, participants, night_start=NIGHT_START_HOUR, night_end=NIGHT_END_HOUR):
     """
     Counts how many messages each participant sends late at night.
     """
     night_owl_counts = {name: 0 for name in participants}
     for msg in messages:
         # timestamp_ms is in milliseconds, so divide by 1000
-        dt_object = datetime.fromtimestamp(msg['timestamp_ms'] / 1000)
+        dt_object = datetime.fromtimestamp(msg.timestamp_ms / 1000)
         if dt_object.hour >= night_start or dt_object.hour < night_end:
-            night_owl_counts[msg['sender_name']] += 1
+            night_owl_counts[msg.sender_name] += 1
     
     return sorted(night_owl_counts.items(), key=lambda item: item[1], reverse=True)
 
-def get_longest_monologues_per_participant(messages, participants):
+def empty_monologue(author):
     """
-    Finds the longest streak of consecutive messages for each participant.
+    Returns the longest monologue entry of a participant without any messages.
     """
-    longest_monologues = {p: {'author': p, 'message_count': 0, 'monologue_content': [], 'start_time': None, 'end_time': None, 'message_intervals_seconds': []} for p in participants}
+    return {'author': author, 'message_count': 0, 'monologue_content': [], 'start_time': None, 'end_time': None, 'interval_seconds': None, 'next_longest_runs': []}
 
-    if not messages:
-        return longest_monologues
+def start_monologue_run(index, msg):
+    """
+    Starts a run of consecutive messages at messages[index]. A run only keeps its
+    offset, timestamps and interval statistics, never the message contents.
+    """
+    return {
+        'author': msg.sender_name,
+        'start': index,
+        'message_count': 1,
+        'start_timestamp': msg.timestamp_ms,
+        'end_timestamp': msg.timestamp_ms,
+        'interval_total': 0,
+        'interval_min': None,
+        'interval_max': None
+    }
 
-    current_run = 0
-    current_author = None
-    current_monologue_messages = [] # This will now store full message objects
+def add_monologue_interval(run, interval_ms):
+    """
+    Adds the gap between two consecutive messages of a run to its interval statistics.
+    """
+    run['interval_total'] += interval_ms
+    run['interval_min'] = interval_ms if run['interval_min'] is None else min(run['interval_min'], interval_ms)
+    run['interval_max'] = interval_ms if run['interval_max'] is None else max(run['interval_max'], interval_ms)
 
-    # Sort messages by timestamp to ensure consecutive messages are correctly identified
-    messages.sort(key=lambda x: x.get('timestamp_ms', 0))
+def extend_monologue_run(run, msg, max_gap_ms=None):
+    """
+    Adds msg to the run if it continues it: same author and, when max_gap_ms is set,
+    sent at most max_gap_ms after the previous message. Returns whether it did.
+    """
+    interval = msg.timestamp_ms - run['end_timestamp']
+    if msg.sender_name != run['author'] or (max_gap_ms is not None and interval > max_gap_ms):
+        return False
+    add_monologue_interval(run, interval)
+    run['message_count'] += 1
+    run['end_timestamp'] = msg.timestamp_ms
+    return True
+
+def keep_top_run(top_runs, run, top_k):
+    """
+    Keeps run if it is among the top_k longest of its author. top_runs maps authors
+    to min-heaps; on a tie the earlier run is kept.
+    """
+    heap = top_runs.setdefault(run['author'], [])
+    entry = (run['message_count'], -run['start'], run)
+    if len(heap) < top_k:
+        heapq.heappush(heap, entry)
+    elif entry[:2] > heap[0][:2]:
+        heapq.heapreplace(heap, entry)
+
+def ranked_runs(heap):
+    """
+    Returns the runs of a keep_top_run heap, longest first.
+    """
+    return [run for _, _, run in sorted(heap, key=lambda entry: entry[:2], reverse=True)]
 
-    for msg in messages:
-        sender = msg.get('sender_name')
-        
-        if sender == current_author:
-            current_run += 1
-            current_monologue_messages.append(msg)
-        else:
-            # The monologue has been broken. Check if the previous one was a record for that author.
-            if current_author is not None and current_run > longest_monologues.get(current_author, {}).get('message_count', 0):
-                start_ts = current_monologue_messages[0]['timestamp_ms'] / 1000
-                end_ts = current_monologue_messages[-1]['timestamp_ms'] / 1000
-                start_time = datetime.fromtimestamp(start_ts).strftime('%Y-%m-%d %H:%M:%S')
-                end_time = datetime.fromtimestamp(end_ts).strftime('%Y-%m-%d %H:%M:%S')
-                
-                intervals = []
-                for i in range(1, len(current_monologue_messages)):
-                    interval = (current_monologue_messages[i]['timestamp_ms'] - current_monologue_messages[i-1]['timestamp_ms']) / 1000
-                    intervals.append(round(interval, 2))
-
-                longest_monologues[current_author] = {
-                    'author': current_author,
-                    'message_count': current_run,
-                    'monologue_content': [m.get('content', '') for m in current_monologue_messages],
-                    'start_time': start_time,
-                    'end_time': end_time,
-                    'message_intervals_seconds': intervals
-                }
+def monologue_rank(run):
+    """
+    Sort key of runs that no longer have offsets: longest first, then earliest.
+    """
+    return (run['message_count'], -run['start_timestamp'])
+
+def monologue_preview(messages, run, max_messages=MONOLOGUE_PREVIEW_MESSAGES, max_chars=MONOLOGUE_PREVIEW_CHARS):
+    """
+    Loads the contents of the first messages of a run, each cut to max_chars.
+    """
+    end = run['start'] + run['message_count'] if max_messages is None else run['start'] + min(run['message_count'], max_messages)
+    contents = [msg.content for msg in messages[run['start']:end]]
+    if max_chars is None:
+        return contents
+    return [content if len(content) <= max_chars else content[:max_chars] + '...' for content in contents]
+
+def format_monologue(run):
+    """
+    Formats a run of consecutive messages, with its preview loaded, as a longest monologue entry.
+    """
+    intervals = run['message_count'] - 1
+    return {
+        'author': run['author'],
+        'message_count': run['message_count'],
+        'monologue_content': run['preview'],
+        'start_time': datetime.fromtimestamp(run['start_timestamp'] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+        'end_time': datetime.fromtimestamp(run['end_timestamp'] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+        'interval_seconds': {
+            'min': round(run['interval_min'] / 1000, 2),
+            'mean': round(run['interval_total'] / intervals / 1000, 2),
+            'max': round(run['interval_max'] / 1000, 2)
+        } if intervals else None
+    }
+
+def summarize_monologues(runs_by_author, participants):
+    """
+    Builds the longest monologues section from each author's runs, longest first.
+    """
+    monologues = {p: empty_monologue(p) for p in participants}
+    for author, runs in runs_by_author.items():
+        if runs:
+            formatted = [format_monologue(run) for run in runs]
+            monologues[author] = dict(formatted[0], next_longest_runs=formatted[1:])
+
+    # Sort the results by message count in descending order
+    sorted_monologues = sorted(monologues.values(), key=lambda x: x['message_count'], reverse=True)
+    return {item['author']: item for item in sorted_monologues}
+
+def get_longest_monologues_per_participant(messages, participants, top_k=MONOLOGUE_TOP_K, max_gap_minutes=MONOLOGUE_MAX_GAP_MINUTES):
+    """
+    Finds the top_k longest streaks of consecutive messages for each participant.
+    Streaks are detected in one pass that only tracks offsets and timestamps; message
+    contents are loaded for the winning streaks only, as a preview.
+    """
+    if not messages:
+        return summarize_monologues({}, participants)
+
+    # Sort messages by timestamp to ensure consecutive messages are correctly identified
+    messages.sort(key=lambda x: x.timestamp_ms)
+    max_gap_ms = None if max_gap_minutes is None else max_gap_minutes * 60 * 1000
+
+    top_runs = {}
+    run = None
+    for index, msg in enumerate(messages):
+        if run is None or not extend_monologue_run(run, msg, max_gap_ms):
+            if run is not None:
+                keep_top_run(top_runs, run, top_k)
+            run = start_monologue_run(index, msg)
+    keep_top_run(top_runs, run, top_k)
+
+    runs_by_author = {author: [dict(run, preview=monologue_preview(messages, run)) for run in ranked_runs(heap)] for author, heap in top_runs.items()}
+    return summarize_monologues(runs_by_author, participants)
+
+def get_question_askers(messages, participants):
+    """
+    Counts how many questions each participant asks.
+    """
+    question_counts = {name: 0 for name in participants}
+    for msg in messages:
+        content = msg.content
+        if content and '?' in content:
+            question_counts[msg.sender_name] += 1
+            
+    return sorted(question_counts.items(), key=lambda item: item[1], reverse=True)
+
+def get_special_mentions(messages, participants):
+    """
+    Counts how many times each participant is mentioned.
+    """
+    mention_counts = {name: 0 for name in participants}
+    mention_pattern = build_mention_pattern(participants)
+
+    for msg in messages:
+        for participant in get_mentioned_participants(msg.content, participants, mention_pattern):
+            mention_counts[participant] += 1
+            
+    return sorted(mention_counts.items(), key=lambda item: item[1], reverse=True)
+
+def build_mention_pattern(participants):
+    """
+    Builds the regex that matches full participant names preceded by an @.
+    """
+    # This is more robust than simple string checking.
+    # We use word boundaries to avoid matching parts of names.
+    participant_regex = r'(?<!\w)@(' + '|'.join(re.escape(p) for p in participants) + r')\b'
+    return re.compile(participant_regex, re.IGNORECASE)
+
+def get_mentioned_participants(content, participants, mention_pattern):
+    """
+    Returns the participant for every @mention in the content (with repeats).
+    """
+    mentioned = []
+    if content and '@' in content:
+        for mention in mention_pattern.findall(content):
+            # Find the full name that matches the mention
+            for participant in participants:
+                if participant.lower() == mention.lower():
+                    mentioned.append(participant)
+                    break
+    return mentioned
+
+def describe_message(msg):
+    """
+    Returns a short label for a message: its content, or the kind of attachment it carries.
+    """
+    if msg.content:
+        return msg.content
+    labels = {'photos': '[photo]', 'videos': '[video]', 'gifs': '[gif]', 'audio_files': '[audio]', 'files': '[file]'}
+    if msg.attachments:
+        return labels[msg.attachments[0][0]]
+    if msg.has_sticker:
+        return '[sticker]'
+    return '[message]'
+
+def collect_reactions(messages, reaction_notices, participants, top_n=5, keep_delays=False):
+    """
+    Collects reaction statistics from the structured 'reactions' field of every message
+    (including attachments) in a single pass: reactions given and received, a reactor ->
+    author index, the most reacted messages and reaction latency digests.
+    Reaction latency is estimated by pairing each reaction notice with the latest earlier
+    message that carries the same reaction from the same person, since the export does
+    not store when a reaction was made. With keep_delays, every delay is also kept so
+    that the median is exact; digests are only needed to merge partial aggregates.
+    """
+    state = {
+        'given': {name: Counter() for name in participants},
+        'received': {name: Counter() for name in participants},
+        'reactor_to_author': {name: Counter() for name in participants},
+        'latency': {name: TDigest() for name in participants},
+        'latency_total': {name: 0 for name in participants},
+        'most_reacted': []
+    }
+    if keep_delays:
+        state['delays'] = {name: [] for name in participants}
+    reacted_messages = []
+
+    # Merge messages and notices into one timestamp-ordered stream
+    stream = [(msg.timestamp_ms, 0, msg) for msg in messages if msg.reactions]
+    stream.extend((notice['timestamp_ms'], 1, notice) for notice in reaction_notices)
+    stream.sort(key=lambda item: (item[0], item[1]))
+
+    # (reactor, reaction) -> timestamp of the latest message carrying that reaction
+    pending = {}
+    for timestamp, is_notice, item in stream:
+        if is_notice:
+            target_timestamp = pending.pop((item['sender_name'], item['reaction']), None)
+            if target_timestamp is not None and item['sender_name'] in state['latency']:
+                delay = (timestamp - target_timestamp) / 1000
+                state['latency'][item['sender_name']].add(delay)
+                state['latency_total'][item['sender_name']] += delay
+                if keep_delays:
+                    state['delays'][item['sender_name']].append(delay)
+            continue
+
+        author = item.sender_name
+        reacted_messages.append((len(item.reactions), timestamp, item))
+        for reactor, emoji_used in item.reactions:
+            if reactor in state['given']:
+                state['given'][reactor][emoji_used] += 1
+                state['reactor_to_author'][reactor][author] += 1
+            if author in state['received']:
+                state['received'][author][emoji_used] += 1
+            pending[(reactor, emoji_used)] = timestamp
+
+    for count, timestamp, msg in heapq.nlargest(top_n, reacted_messages, key=lambda item: (item[0], item[1])):
+        state['most_reacted'].append([count, timestamp, {
+            'author': msg.sender_name,
+            'content': describe_message(msg),
+            'reaction_count': count,
+            'reactions': [list(reaction) for reaction in msg.reactions],
+            'time': datetime.fromtimestamp(timestamp / 1000).strftime('%Y-%m-%d %H:%M:%S')
+        }])
+    return state
+
+def summarize_reactions(state, participants, top_n=5):
+    """
+    Turns collected reaction statistics into the reaction analysis section.
+    """
+    by_participant = {}
+    for name in participants:
+        given = Counter(state['given'].get(name, {}))
+        received = Counter(state['received'].get(name, {}))
+        digest = state['latency'].get(name) or TDigest()
+        if 'delays' in state:
+            delays = sorted(state['delays'][name])
+            median = delays[len(delays) // 2] if delays else None
+        else:
+            median = digest.quantile(0.5) if digest.count else None
+        by_participant[name] = {
+            'reactions_given': sum(given.values()),
+            'reactions_received': sum(received.values()),
+            'top_reactions_given': given.most_common(top_n),
+            'top_reactions_received': received.most_common(top_n),
+            'reacts_most_to': Counter(state['reactor_to_author'].get(name, {})).most_common(),
+            'reaction_latency_seconds': {
+                'samples': digest.count,
+                'median': round(median, 2) if median is not None else None,
+                'mean': round(state['latency_total'][name] / digest.count, 2) if digest.count else None
+            }
+        }
+
+    return {
+        'most_reacted_messages': [entry for count, timestamp, entry in state['most_reacted'][:top_n]],
+        'by_participant': by_participant
+    }
+
+def get_reaction_analysis(messages, reaction_notices, participants, top_n=5):
+    """
+    Analyzes the structured 'reactions' field of every message: the most reacted
+    messages, the favourite reaction emojis of each person and how fast people react.
+    """
+    return summarize_reactions(collect_reactions(messages, reaction_notices, participants, top_n, keep_delays=True), participants, top_n)
+
+
+def new_media_stats():
+    """
+    Returns empty media statistics for one participant.
+    """
+    stats = {key: 0 for key in MEDIA_KEYS}
+    stats.update({
+        'stickers': 0,
+        'calls': 0,
+        'call_duration_seconds': 0,
+        'files_found': 0,
+        'files_missing': 0,
+        'media_bytes': 0,
+        'video_seconds': 0,
+        'audio_seconds': 0
+    })
+    return stats
+
+def resolve_media_path(uri, media_root):
+    """
+    Finds an attachment on disk. URIs are relative to the root of the export, but
+    media_root may also point at the conversation folder itself.
+    """
+    parts = uri.split('/')
+    for candidate in (os.path.join(media_root, *parts), os.path.join(media_root, *parts[-2:])):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+def probe_media_file(uri, media_root):
+    """
+    Returns (size in bytes, duration in seconds or None) of an attachment, or None if it is missing.
+    """
+    path = resolve_media_path(uri, media_root)
+    if path is None:
+        return None
+    return os.path.getsize(path), get_media_duration(path)
+
+def get_media_stats(messages, participants, media_root=None, max_workers=MEDIA_WORKERS):
+    """
+    Counts the attachments, stickers and calls of each participant.
+    If media_root is given, the attachment files are also looked up on disk (concurrently,
+    since most of the time is spent waiting on the file system) to add up their sizes and
+    the durations of videos and audio, which are read from the file headers only.
+    """
+    media_stats = {name: new_media_stats() for name in participants}
+    attachments = []
+    for msg in messages:
+        stats = media_stats.get(msg.sender_name)
+        if stats is None:
+            continue
+        for key, uri in msg.attachments:
+            stats[key] += 1
+            if uri:
+                attachments.append((stats, key, uri))
+        if msg.has_sticker:
+            stats['stickers'] += 1
+        if msg.call_duration is not None:
+            stats['calls'] += 1
+            stats['call_duration_seconds'] += msg.call_duration
+
+    if media_root is not None and attachments:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = pool.map(probe_media_file, [uri for stats, key, uri in attachments], itertools.repeat(media_root))
+            for (stats, key, uri), result in zip(attachments, results):
+                if result is None:
+                    stats['files_missing'] += 1
+                    continue
+                size, duration = result
+                stats['files_found'] += 1
+                stats['media_bytes'] += size
+                if duration is not None:
+                    if key == 'videos':
+                        stats['video_seconds'] += duration
+                    elif key == 'audio_files':
+                        stats['audio_seconds'] += duration
+    return media_stats
+
+def summarize_media_stats(media_stats):
+    """
+    Rounds the media statistics for the output.
+    """
+    return {name: {key: round(value, 2) if isinstance(value, float) else value for key, value in stats.items()} for name, stats in media_stats.items()}
+
+
+
+
+
+def analyze_interactions(messages, participants):
+
+
+    """
+
+
+    Analyzes interactions between each pair of participants based on @mentions.
+
+
+    """
+
+
+    # Initialize a structure to hold raw messages for each interaction pair
+
+
+    interaction_messages = {sender: {receiver: [] for receiver in participants if sender != receiver} for sender in participants}
+
+
+
+
+
+    # Regex to find mentions of any participant
+
+
+    mention_pattern = build_interaction_pattern(participants)
+
+
+    
+
+
+    # First pass: collect all messages from a sender that mention a receiver
+
+
+    for msg in messages:
+
+
+        sender = msg.sender_name
+
+
+        for receiver in get_mentioned_receivers(sender, msg.content, participants, mention_pattern):
+
+
+            interaction_messages[sender][receiver].append(msg)
+
+
+
+
+
+    # Second pass: compute statistics for each interaction pair
+
+
+    interaction_analysis = {sender: {receiver: {} for receiver in participants if sender != receiver} for sender in participants}
+
+
+    for sender, receivers in interaction_messages.items():
+
+
+        for receiver, specific_messages in receivers.items():
+
+
+            if not specific_messages:
+
+
+                interaction_analysis[sender][receiver] = {
+
+
+                    'message_count': 0,
+
+
+                    'sentiment': {'pos': 0, 'neu': 0, 'neg': 0},
+
+
+                    'emojis': [],
+
+
+                    'common_words': []
+
+
+                }
+
+
+                continue
+
+
+
+
+
+            # Calculate sentiment, emojis, and common words for this specific interaction
+
+
+            interaction_analysis[sender][receiver] = {
+
+
+                'message_count': len(specific_messages),
+
+
+                'sentiment': get_sentiment(specific_messages),
+
+
+                'emojis': get_emoji_usage(specific_messages, top_n=3),
+
+
+                'common_words': get_word_frequency(specific_messages, participants)[0][:5]
+
+
+            }
+
+
+            
+
+
+    return interaction_analysis
+
+
+
+
+
+def build_interaction_pattern(participants):
+
+
+    """
+
+
+    Builds the regex that matches @mentions of participant first names.
+
+
+    """
+
+
+    # This is a complex regex to avoid matching names that are substrings of other names
+
+
+    # and to ensure we're matching a mention that is likely a standalone word.
+
+
+    participant_regex = r'@(' + '|'.join(re.escape(p.split()[0]) for p in sorted(participants, key=len, reverse=True)) + r')'
+
+
+    return re.compile(participant_regex, re.IGNORECASE)
+
+
+
+
+
+def get_mentioned_receivers(sender, content, participants, mention_pattern):
+
+
+    """
+
+
+    Returns the participants (other than the sender) mentioned by first name in the content.
+
+
+    """
+
+
+    receivers = []
+
+
+    # Find all unique mentions in the message
+
+
+    for mention in set(mention_pattern.findall(content)):
+
+
+        # Find the full participant name that matches the mentioned first name
+
+
+        for receiver in participants:
+
+
+            if sender != receiver and receiver.lower().startswith(mention.lower()):
+
+
+                receivers.append(receiver)
+
+
+                break # Assume first match is the correct one
+
+
+    return receivers
+
+
+
+
+
+def get_greeting_profiles(individual_data):
+
+
+    """
+
+
+    Returns the features of each participant that the greeting rules read, computed
+
+
+    once as arrays in the order of individual_data['participants'].
+
+
+    """
+
+
+    profiles = [individual_data['analysis_by_participant'].get(name, {}) for name in individual_data['participants']]
+
+
+    return {
+
+
+        'positive_percent': np.array([profile.get('sentiment', {}).get('positive_percent', 0) for profile in profiles], dtype=float),
+
+
+        'grade_level': np.array([profile.get('reading_level', {}).get('grade_level', 0) for profile in profiles], dtype=float)
+
+
+    }
+
+
+
+
+
+def iter_inter_participant_greetings(interaction_data, individual_data):
+
+
+    """
+
+
+    Generates personalized Christmas greetings from each participant to every other participant,
+
+
+    yielding (sender, greetings by receiver) one sender at a time.
+
+
+    """
+
+
+    participants = individual_data['participants']
+
+
+    profiles = get_greeting_profiles(individual_data)
+
+
+    size = len(participants)
+
+
+
+
+
+    # Sender -> receiver matrices of the interaction features the rules read
+
+
+    index = {name: i for i, name in enumerate(participants)}
+
+
+    rows, columns, counts, positives, negatives = [], [], [], [], []
+
+
+    for sender, receivers in interaction_data.items():
+
+
+        i = index[sender]
+
+
+        for receiver, interaction in receivers.items():
+
+
+            sentiment = interaction.get('sentiment', {})
+
+
+            rows.append(i)
+
+
+            columns.append(index[receiver])
+
+
+            counts.append(interaction['message_count'])
+
+
+            positives.append(sentiment.get('positive_percent', 0))
+
+
+            negatives.append(sentiment.get('negative_percent', 0))
+
+
+    has_pair = np.zeros((size, size), dtype=bool)
+
+
+    has_pair[rows, columns] = True
+
+
+    message_counts = np.zeros((size, size))
+
+
+    message_counts[rows, columns] = counts
+
+
+    pair_positive = np.zeros((size, size))
 
-            # Start a new monologue
-            current_author = sender
-            current_run = 1
-            current_monologue_messages = [msg]
-
-    # Check the very last monologue in the chat
-    if current_author is not None and current_run > longest_monologues.get(current_author, {}).get('message_count', 0):
-        start_ts = current_monologue_messages[0]['timestamp_ms'] / 1000
-        end_ts = current_monologue_messages[-1]['timestamp_ms'] / 1000
-        start_time = datetime.fromtimestamp(start_ts).strftime('%Y-%m-%d %H:%M:%S')
-        end_time = datetime.fromtimestamp(end_ts).strftime('%Y-%m-%d %H:%M:%S')
-
-        intervals = []
-        for i in range(1, len(current_monologue_messages)):
-            interval = (current_monologue_messages[i]['timestamp_ms'] - current_monologue_messages[i-1]['timestamp_ms']) / 1000
-            intervals.append(round(interval, 2))
-        
-        longest_monologues[current_author] = {
-            'author': current_author,
-            'message_count': current_run,
-            'monologue_content': [m.get('content', '') for m in current_monologue_messages],
-            'start_time': start_time,
-            'end_time': end_time,
-            'message_intervals_seconds': intervals
-        }
 
-    # Sort the results by message count in descending order
-    sorted_monologues = sorted(longest_monologues.values(), key=lambda x: x['message_count'], reverse=True)
-    
-    return {item['author']: item for item in sorted_monologues if item['author'] is not None}
+    pair_positive[rows, columns] = positives
 
-def get_question_askers(messages, participants):
-    """
-    Counts how many questions each participant asks.
-    """
-    question_counts = {name: 0 for name in participants}
-    for msg in messages:
-        content = msg.get('content', '')
-        if content and '?' in content:
-            question_counts[msg['sender_name']] += 1
-            
-    return sorted(question_counts.items(), key=lambda item: item[1], reverse=True)
 
-def get_special_mentions(messages, participants):
-    """
-    Counts how many times each participant is mentioned.
-    """
-    mention_counts = {name: 0 for name in participants}
-    
-    # Create a regex pattern to match any of the participant names preceded by an @
-    # This is more robust than simple string checking.
-    # We use word boundaries to avoid matching parts of names.
-    participant_regex = r'(?<!\w)@(' + '|'.join(re.escape(p) for p in participants) + r')\b'
-    mention_pattern = re.compile(participant_regex, re.IGNORECASE)
+    pair_negative = np.zeros((size, size))
 
-    for msg in messages:
-        content = msg.get('content', '')
-        if content and '@' in content:
-            mentions = mention_pattern.findall(content)
-            for mention in mentions:
-                # Find the full name that matches the mention
-                for participant in participants:
-                    if participant.lower() == mention.lower():
-                        mention_counts[participant] += 1
-                        break
-            
-    return sorted(mention_counts.items(), key=lambda item: item[1], reverse=True)
 
+    pair_negative[rows, columns] = negatives
 
 
 
 
-def analyze_interactions(messages, participants):
 
+    # --- Gift Logic ---
 
-    """
 
+    gifts = np.select([
 
-    Analyzes interactions between each pair of participants based on @mentions.
 
+        message_counts == 0,
 
-    """
 
+        pair_positive > 80,
 
-    # Initialize a structure to hold raw messages for each interaction pair
 
+        pair_negative > 50,
 
-    interaction_messages = {sender: {receiver: [] for receiver in participants if sender != receiver} for sender in participants}
 
+        np.broadcast_to(profiles['grade_level'][:, None] > 12, (size, size))
 
 
+    ], [1, 2, 3, 4], default=0) # Default: socks
 
 
-    # Regex to find mentions of any participant
 
 
-    # This is a complex regex to avoid matching names that are substrings of other names
 
+    # --- Greeting & Blessing Logic ---
 
-    # and to ensure we're matching a mention that is likely a standalone word.
 
+    # If sender is very positive specifically towards the receiver, else in general
 
-    participant_regex = r'@(' + '|'.join(re.escape(p.split()[0]) for p in sorted(participants, key=len, reverse=True)) + r')'
 
+    styles = np.select([
 
-    mention_pattern = re.compile(participant_regex, re.IGNORECASE)
 
+        pair_positive > 70,
 
-    
 
+        np.broadcast_to(profiles['positive_percent'][:, None] > 70, (size, size))
 
-    # First pass: collect all messages from a sender that mention a receiver
 
+    ], [2, 1], default=0)
 
-    for msg in messages:
 
 
-        sender = msg['sender_name']
 
 
-        content = msg.get('content', '')
+    first_names = [name.split()[0] for name in participants]
 
 
-        
+    plain_greetings = [f"Merry Christmas, {first_name}!" for first_name in first_names]
 
 
-        # Find all unique mentions in the message
+    cheerful_greetings = [f"Merry Christmas, {first_name}! Hope you have a wonderful time! 🎄" for first_name in first_names]
 
 
-        mentions_found = set(mention_pattern.findall(content))
+    blessings = [
 
 
-        
+        "Wishing you all the best this holiday season.",
 
 
-        for mention in mentions_found:
+        "May your Christmas sparkle with moments of love, laughter, and goodwill!",
 
 
-            # Find the full participant name that matches the mentioned first name
+        "So grateful for you this holiday season! Hope you have the best time."
 
 
-            for receiver in participants:
+    ]
 
 
-                if sender != receiver and receiver.lower().startswith(mention.lower()):
+    for i, sender in enumerate(participants):
 
 
-                    interaction_messages[sender][receiver].append(msg)
+        gift_names = [
 
 
-                    break # Assume first match is the correct one
+            "A Pair of Cozy Socks",
 
 
+            "A 'Thinking of You' Card (since we don't talk much!)",
 
 
+            f"A Framed Photo of You and {sender}",
 
-    # Second pass: compute statistics for each interaction pair
 
+            "A Boxing Glove (for our next debate)",
 
-    interaction_analysis = {sender: {receiver: {} for receiver in participants if sender != receiver} for sender in participants}
 
+            "A Book Recommendation"
 
-    for sender, receivers in interaction_messages.items():
 
+        ]
 
-        for receiver, specific_messages in receivers.items():
 
+        # Plain lists are much faster to index one pair at a time than arrays
 
-            if not specific_messages:
 
+        pair_row, style_row, gift_row = has_pair[i].tolist(), styles[i].tolist(), gifts[i].tolist()
 
-                interaction_analysis[sender][receiver] = {
 
+        greetings = {}
 
-                    'message_count': 0,
 
+        for j, receiver in enumerate(participants):
 
-                    'sentiment': {'pos': 0, 'neu': 0, 'neg': 0},
 
+            if i == j:
 
-                    'emojis': [],
+
+                continue
 
 
-                    'common_words': []
+            if not pair_row[j]:
 
 
-                }
+                greetings[receiver] = {}
 
 
                 continue
 
 
+            style = style_row[j]
 
 
+            if style == 2:
 
-            # Calculate sentiment, emojis, and common words for this specific interaction
 
+                emojis_to_receiver = ''.join([e[0] for e in interaction_data[sender][receiver].get('emojis', [])])
 
-            interaction_analysis[sender][receiver] = {
 
+                greeting = f"To my dear {first_names[j]}, Merry Christmas! {emojis_to_receiver}"
 
-                'message_count': len(specific_messages),
 
+            else:
 
-                'sentiment': get_sentiment(specific_messages),
 
+                greeting = cheerful_greetings[j] if style == 1 else plain_greetings[j]
 
-                'emojis': get_emoji_usage(specific_messages, top_n=3),
 
+            greetings[receiver] = {
 
-                'common_words': get_word_frequency(specific_messages, participants)[0][:5]
 
+                'greeting': greeting,
 
-            }
 
+                'blessing': blessings[style],
 
-            
 
+                'gift': gift_names[gift_row[j]]
 
-    return interaction_analysis
+
+            }
+
+
+        yield sender, greetings
 
 
 
@@ -647,218 +1875,1073 @@ def generate_inter_participant_greetings(interaction_data, individual_data):
     """
 
 
-    greetings = {sender: {receiver: {} for receiver in individual_data['participants'] if sender != receiver} for sender in individual_data['participants']}
+    return dict(iter_inter_participant_greetings(interaction_data, individual_data))
 
 
-    
 
 
-    for sender, receivers in interaction_data.items():
 
+# --- SAMPLED PREVIEW ---
+# A quick approximate report: the language analyses run on a random sample of each
+# sender's messages in each month (a stratified sample), and their counts and
+# percentages are scaled up to the full chat with 95% confidence intervals.
+# Sections that only look at timestamps are cheap and stay exact.
 
-        for receiver, interaction in receivers.items():
+def stratified_sample(messages, fraction, seed=SAMPLE_SEED):
+    """
+    Samples the given fraction (at least one message) of every sender's messages in
+    every period. Returns {(sender, period): (number of messages, sampled messages)}.
+    """
+    strata = {}
+    for msg in messages:
+        period = datetime.fromtimestamp(msg.timestamp_ms / 1000).strftime(SAMPLE_PERIOD_FORMAT)
+        strata.setdefault((msg.sender_name, period), []).append(msg)
+
+    rng = random.Random(seed)
+    sampled = {}
+    for key in sorted(strata):
+        stratum = strata[key]
+        size = max(1, round(len(stratum) * fraction))
+        chosen = sorted(rng.sample(range(len(stratum)), size))
+        sampled[key] = (len(stratum), [stratum[i] for i in chosen])
+    return sampled
+
+def estimate_counts(strata, measure):
+    """
+    Estimates totals over all messages of the given strata from their samples.
+    measure(msg) returns a dict of counts for one message. Returns {key: (estimate,
+    half width of the 95% confidence interval, sample size)}. Strata with a single
+    sampled message add nothing to the interval, as their variance is unknown.
+    """
+    sums = {}
+    squares = {}
+    for index, (population, sample) in enumerate(strata):
+        for msg in sample:
+            for key, value in measure(msg).items():
+                if value:
+                    stratum_sums = sums.setdefault(key, {})
+                    stratum_sums[index] = stratum_sums.get(index, 0) + value
+                    stratum_squares = squares.setdefault(key, {})
+                    stratum_squares[index] = stratum_squares.get(index, 0) + value * value
+
+    sample_size = sum(len(sample) for _, sample in strata)
+    estimates = {}
+    for key in sums:
+        total = 0
+        variance = 0
+        for index, value_sum in sums[key].items():
+            population, sample = strata[index]
+            n = len(sample)
+            total += population * value_sum / n
+            if n > 1:
+                sample_variance = (squares[key][index] - value_sum * value_sum / n) / (n - 1)
+                variance += population * population * (1 - n / population) * sample_variance / n
+        estimates[key] = (total, CONFIDENCE_Z * math.sqrt(max(variance, 0)), sample_size)
+    return estimates
+
+def format_estimate(estimate, scale=1):
+    """
+    Formats an (estimate, half width, sample size) tuple, optionally scaled
+    (e.g. to a percentage), for the estimates section of a sampled report.
+    """
+    value, half_width, sample_size = estimate
+    return {
+        'value': round(value * scale, 2),
+        'ci_95': [round(max(value - half_width, 0) * scale, 2), round((value + half_width) * scale, 2)],
+        'sample_size': sample_size
+    }
 
+def missing_estimate(strata):
+    """
+    Returns the estimate of a key never seen in the sample of the given strata: 0,
+    with the rule of three as the upper end of its interval. The interval is empty
+    if nothing was sampled (e.g. all of a sender's sampled messages were copypasta).
+    """
+    population = sum(count for count, _ in strata)
+    sample_size = sum(len(sample) for _, sample in strata)
+    if not sample_size:
+        return (0, 0, 0)
+    # A key cannot occur more often than there are messages
+    return (0, min(3 * population / sample_size, population), sample_size)
+
+def summarize_estimates(estimates, keys, strata):
+    """
+    Returns the estimated count of each key and the matching estimates section.
+    Keys never seen in the sample are estimated with missing_estimate.
+    """
+    missing = missing_estimate(strata)
+    counts = {key: round(estimates.get(key, missing)[0]) for key in keys}
+    return counts, {key: format_estimate(estimates.get(key, missing)) for key in keys}
 
-            sender_profile = individual_data['analysis_by_participant'][sender]
+def top_estimates(estimates, top_n, excluded=()):
+    """
+    Returns the top_n keys with the largest estimated counts as [key, count] pairs.
+    """
+    ranked = sorted((key for key in estimates if key not in excluded), key=lambda key: estimates[key][0], reverse=True)[:top_n]
+    return [(key, round(estimates[key][0])) for key in ranked]
 
+def run_sampled_analysis(messages, fraction, media_root=None, stream_greetings=False):
+    """
+    Runs a quick approximate analysis on a stratified sample of the messages (records
+    or exported dicts). Returns the usual results, where sample-based figures are
+    estimates for the whole chat, plus an 'estimates' section with confidence
+    intervals and sample sizes, and a 'sampling' section describing the sample.
+    With stream_greetings, the greetings are left as an iterator as in run_analysis.
+    """
+    messages, exact_duplicates = remove_exact_duplicates(compact_messages(messages))
+    text_messages, reaction_notices = prepare_messages(messages)
+    text_messages.sort(key=lambda x: x.timestamp_ms)
+    participants = sorted(list(set(msg.sender_name for msg in text_messages)))
+
+    strata = stratified_sample(text_messages, fraction)
+    sampled_messages = sorted((msg for _, sample in strata.values() for msg in sample), key=lambda x: x.timestamp_ms)
+    # Near-duplicates are only looked for in the sample; each stratum shrinks by the share dropped from its sample
+    sampled_messages, copypasta_clusters, near_duplicates = find_copypasta(sampled_messages)
+    kept = set(map(id, sampled_messages))
+    for key, (count, sample) in list(strata.items()):
+        kept_sample = [msg for msg in sample if id(msg) in kept]
+        if kept_sample:
+            strata[key] = (count * len(kept_sample) / len(sample), kept_sample)
+        else:
+            del strata[key]
+    print(f"Sampled {len(sampled_messages)} of {len(text_messages)} text messages from {len(participants)} participants.")
 
-            
+    stop_words = get_stop_words()
+    participant_names = get_participant_name_words(participants)
+    analysis_by_participant = {}
+    estimates_by_participant = {}
+    for name in participants:
+        participant_strata = [stratum for (sender, _), stratum in strata.items() if sender == name]
+        population = sum(count for count, _ in participant_strata)
+        participant_sample = sorted((msg for _, sample in participant_strata for msg in sample), key=lambda x: x.timestamp_ms)
+        sample_size = len(participant_sample)
+        print(f"\nAnalyzing a sample of {sample_size} messages for {name}...")
+
+        word_estimates = estimate_counts(participant_strata, lambda msg: Counter(get_content_words(msg.content, stop_words)))
+        most_common = top_estimates(word_estimates, TOP_N_WORDS, participant_names)
+        custom_counts, custom_estimates = summarize_estimates(word_estimates, CUSTOM_WORDS_TO_COUNT, participant_strata)
+
+        compounds = dict(zip((id(msg) for msg in participant_sample), get_sentiment_scorer().compound_scores([msg.content for msg in participant_sample])))
+        tally = new_sentiment_tally()
+        for msg in participant_sample:
+            add_sentiment(tally, msg.content, compounds[id(msg)])
+
+        def sentiment_class(msg):
+            compound = compounds[id(msg)]
+            return {'positive_percent': compound >= 0.05, 'negative_percent': compound <= -0.05, 'neutral_percent': -0.05 < compound < 0.05}
+
+        sentiment_estimates = estimate_counts(participant_strata, sentiment_class)
+        sentiment = summarize_sentiment(tally)
+        sentiment_section = {}
+        for key in ('positive_percent', 'neutral_percent', 'negative_percent'):
+            sentiment_section[key] = format_estimate(sentiment_estimates.get(key, missing_estimate(participant_strata)), 100 / population if population else 0)
+            sentiment[key] = sentiment_section[key]['value']
+
+        emoji_estimates = estimate_counts(participant_strata, lambda msg: dict(get_emoji_usage([msg], top_n=None)))
+        emoji_usage = top_estimates(emoji_estimates, 5)
+        excuse_counts, excuse_estimates = summarize_estimates(estimate_counts(participant_strata, lambda msg: get_excuse_factor([msg])), EXCUSE_WORDS, participant_strata)
+        pos_counts, pos_estimates = summarize_estimates(estimate_counts(participant_strata, lambda msg: get_pos_counts([msg])), ['adjectives', 'verbs', 'nouns'], participant_strata)
+        pronoun_counts, pronoun_estimates = summarize_estimates(estimate_counts(participant_strata, lambda msg: get_self_pronoun_counts([msg])), SELF_PRONOUNS, participant_strata)
+
+        analysis_by_participant[name] = {
+            'most_common_words': most_common,
+            'vocabulary_richness': get_vocabulary_richness(participant_sample, participants),
+            'custom_word_counts': custom_counts,
+            'reading_level': get_reading_level(participant_sample),
+            'sentiment': sentiment,
+            'emoji_usage': emoji_usage,
+            'excuse_factor': excuse_counts,
+            'pos_counts': pos_counts,
+            'self_pronoun_counts': pronoun_counts
+        }
+        estimates_by_participant[name] = {
+            'message_count': {'value': round(population), 'sample_size': sample_size},
+            'most_common_words': {word: format_estimate(word_estimates[word]) for word, _ in most_common},
+            'vocabulary_richness': {'sample_size': sample_size},
+            'custom_word_counts': custom_estimates,
+            'reading_level': {'sample_size': sample_size},
+            'sentiment': sentiment_section,
+            'emoji_usage': {emj: format_estimate(emoji_estimates[emj]) for emj, _ in emoji_usage},
+            'excuse_factor': excuse_estimates,
+            'pos_counts': pos_estimates,
+            'self_pronoun_counts': pronoun_estimates
+        }
+        print(f"  - Sampled analysis complete.")
 
+    all_strata = list(strata.values())
+    emoji_estimates = estimate_counts(all_strata, lambda msg: dict(get_overall_emoji_usage([msg], top_n=None)))
+    night_owl_estimates = estimate_counts(all_strata, lambda msg: dict(get_night_owl_score([msg], [msg.sender_name])))
+    question_estimates = estimate_counts(all_strata, lambda msg: dict(get_question_askers([msg], [msg.sender_name])))
+    mention_estimates = estimate_counts(all_strata, lambda msg: dict(get_special_mentions([msg], participants)))
 
-            # --- Gift Logic ---
+    def ranked(estimates):
+        counts, section = summarize_estimates(estimates, participants, all_strata)
+        return sorted(counts.items(), key=lambda item: item[1], reverse=True), section
 
+    night_owl_score, night_owl_section = ranked(night_owl_estimates)
+    question_askers, question_section = ranked(question_estimates)
+    special_mentions, mention_section = ranked(mention_estimates)
+    top_emojis = top_estimates(emoji_estimates, 5)
 
-            gift = "A Pair of Cozy Socks" # Default
+    # Timestamp-only sections are cheap, so they use every message
+    overall_analysis = {}
+    overall_analysis['top_emojis'] = top_emojis
+    overall_analysis['chat_initiator'] = get_chat_initiator(text_messages)
+    overall_analysis['night_owl_score'] = night_owl_score
+    overall_analysis['longest_monologues_per_participant'] = get_longest_monologues_per_participant(text_messages, participants)
+    overall_analysis['question_askers'] = question_askers
+    overall_analysis['special_mentions'] = special_mentions
+    overall_analysis['reply_latency'] = get_reply_latency(text_messages, participants)
+    overall_analysis['reaction_analysis'] = get_reaction_analysis(messages, reaction_notices, participants)
+    overall_analysis['media_analysis'] = summarize_media_stats(get_media_stats(messages, participants, media_root))
+    overall_analysis['copypasta'] = summarize_copypasta(copypasta_clusters, exact_duplicates, near_duplicates)
+    overall_analysis['interaction_analysis'] = analyze_interactions(sampled_messages, participants)
+    print(f"\nOverall analysis complete.")
 
+    final_output = {
+        'participants': participants,
+        'analysis_by_participant': analysis_by_participant,
+        'overall_analysis': overall_analysis,
+    }
+    greetings = iter_inter_participant_greetings if stream_greetings else generate_inter_participant_greetings
+    final_output['inter_participant_christmas_greetings'] = greetings(overall_analysis['interaction_analysis'], final_output)
+    final_output['estimates'] = {
+        'analysis_by_participant': estimates_by_participant,
+        'overall_analysis': {
+            'top_emojis': {emj: format_estimate(emoji_estimates[emj]) for emj, _ in top_emojis},
+            'night_owl_score': night_owl_section,
+            'question_askers': question_section,
+            'special_mentions': mention_section,
+            'copypasta': {'sample_size': len(sampled_messages)},
+            'interaction_analysis': {'sample_size': len(sampled_messages)}
+        }
+    }
+    final_output['sampling'] = {
+        'fraction': fraction,
+        'seed': SAMPLE_SEED,
+        'strata': 'sender and ' + next((name for name, period_format in PERIOD_FORMATS.items() if period_format == SAMPLE_PERIOD_FORMAT), SAMPLE_PERIOD_FORMAT),
+        'confidence_level': 0.95,
+        'population_size': len(text_messages),
+        'sample_size': len(sampled_messages),
+        'exact_sections': ['chat_initiator', 'longest_monologues_per_participant', 'reply_latency', 'reaction_analysis', 'media_analysis']
+    }
+    return final_output
 
-            if interaction['message_count'] == 0:
+# --- DAILY BUCKETS ---
+# The counters behind word frequency, emoji, sentiment, night owl, question and
+# mention results are kept per day and participant, so the results for any date
+# range (e.g. a yearly "wrapped" or monthly reports) come from merging buckets
+# instead of rerunning the analysis.
 
+BUCKET_FORMAT_VERSION = 1
 
-                gift = "A 'Thinking of You' Card (since we don't talk much!)"
+def new_day_bucket():
+    """
+    Returns the empty counters of one participant on one day.
+    """
+    return {
+        'message_count': 0,
+        'word_counts': Counter(),
+        'emoji_counts': Counter(),
+        'sentiment': new_sentiment_tally(),
+        'night_owl': 0,
+        'questions': 0,
+        'mentions': 0
+    }
 
+def add_day_bucket(total, bucket):
+    """
+    Adds a day bucket into total in place; total must come before bucket in time.
+    """
+    total['message_count'] += bucket['message_count']
+    total['word_counts'].update(bucket['word_counts'])
+    total['emoji_counts'].update(bucket['emoji_counts'])
+    total['sentiment'] = merge_sentiment(total['sentiment'], bucket['sentiment'])
+    total['night_owl'] += bucket['night_owl']
+    total['questions'] += bucket['questions']
+    total['mentions'] += bucket['mentions']
+
+def collect_daily_buckets(messages, participants):
+    """
+    Counts sorted text messages into buckets by day ('YYYY-MM-DD', local time) and participant.
+    """
+    stop_words = get_stop_words()
+    compounds = get_sentiment_scorer().compound_scores([msg.content for msg in messages])
+    mention_pattern = build_mention_pattern(participants)
+
+    days = {}
+    for msg, compound in zip(messages, compounds):
+        content = msg.content
+        dt_object = datetime.fromtimestamp(msg.timestamp_ms / 1000)
+        day = days.setdefault(dt_object.strftime('%Y-%m-%d'), {})
+        bucket = day.get(msg.sender_name)
+        if bucket is None:
+            bucket = day[msg.sender_name] = new_day_bucket()
+
+        bucket['message_count'] += 1
+        bucket['word_counts'].update(get_content_words(content, stop_words))
+        bucket['emoji_counts'].update(emj['emoji'] for emj in emoji.emoji_list(content))
+        add_sentiment(bucket['sentiment'], content, compound)
+        if dt_object.hour >= NIGHT_START_HOUR or dt_object.hour < NIGHT_END_HOUR:
+            bucket['night_owl'] += 1
+        if '?' in content:
+            bucket['questions'] += 1
+        for mentioned in get_mentioned_participants(content, participants, mention_pattern):
+            mentioned_bucket = day.get(mentioned)
+            if mentioned_bucket is None:
+                mentioned_bucket = day[mentioned] = new_day_bucket()
+            mentioned_bucket['mentions'] += 1
+    return days
+
+def merge_daily_buckets(days):
+    """
+    Merges day buckets, in date order, into one bucket per participant.
+    The counters are accumulated in place, so each day costs only its own size.
+    """
+    totals = {}
+    for day in sorted(days):
+        for name, bucket in days[day].items():
+            total = totals.get(name)
+            if total is None:
+                total = totals[name] = new_day_bucket()
+            add_day_bucket(total, bucket)
+    return totals
+
+def summarize_buckets(totals, participants):
+    """
+    Turns merged buckets into the word frequency, sentiment, emoji, night owl,
+    question and mention results of advanced_analysis.json.
+    """
+    totals = {name: totals.get(name) or new_day_bucket() for name in participants}
 
-            elif interaction.get('sentiment', {}).get('positive_percent', 0) > 80:
+    analysis_by_participant = {}
+    overall_emojis = Counter()
+    for name in participants:
+        bucket = totals[name]
+        most_common, custom_counts = summarize_word_counts(bucket['word_counts'], participants)
+        analysis_by_participant[name] = {
+            'message_count': bucket['message_count'],
+            'most_common_words': most_common,
+            'custom_word_counts': custom_counts,
+            'sentiment': summarize_sentiment(bucket['sentiment']),
+            'emoji_usage': Counter(bucket['emoji_counts']).most_common(5)
+        }
+        overall_emojis.update(bucket['emoji_counts'])
 
+    overall_analysis = {
+        'top_emojis': overall_emojis.most_common(5),
+        'night_owl_score': sorted(((name, totals[name]['night_owl']) for name in participants), key=lambda item: item[1], reverse=True),
+        'question_askers': sorted(((name, totals[name]['questions']) for name in participants), key=lambda item: item[1], reverse=True),
+        'special_mentions': sorted(((name, totals[name]['mentions']) for name in participants), key=lambda item: item[1], reverse=True)
+    }
+    return {
+        'participants': participants,
+        'analysis_by_participant': analysis_by_participant,
+        'overall_analysis': overall_analysis
+    }
 
-                gift = f"A Framed Photo of You and {sender}"
+def save_daily_buckets(days, participants, buckets_file):
+    """
+    Saves day buckets for later date range reports.
+    """
+    with open(buckets_file, 'w', encoding='utf-8') as f:
+        json.dump({'version': BUCKET_FORMAT_VERSION, 'participants': participants, 'days': days}, f)
 
+def report_date_range(buckets_file, output_file, since=None, until=None, split=None):
+    """
+    Date range CLI: writes the bucketed results between since and until, merged from
+    saved day buckets. With split ('day', 'month' or 'year') one report is written
+    per period, keyed by period.
+    """
+    try:
+        with open(buckets_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        print(f"ERROR: Could not read day buckets '{buckets_file}'. Run the analysis first. Details: {e}")
+        return
+    if data.get('version') != BUCKET_FORMAT_VERSION:
+        print(f"ERROR: '{buckets_file}' was written by an incompatible version of this script.")
+        return
 
-            elif interaction.get('sentiment', {}).get('negative_percent', 0) > 50:
+    for day in (since, until):
+        if day is not None:
+            try:
+                valid = datetime.strptime(day, '%Y-%m-%d').strftime('%Y-%m-%d') == day
+            except ValueError:
+                valid = False
+            if not valid:
+                print(f"ERROR: '{day}' is not a date in YYYY-MM-DD format.")
+                return
+
+    participants = data['participants']
+    # Days are 'YYYY-MM-DD', so they compare like dates; both limits are inclusive
+    days = {day: buckets for day, buckets in data['days'].items() if (since is None or day >= since) and (until is None or day <= until)}
+    if split is None:
+        report = dict(summarize_buckets(merge_daily_buckets(days), participants), since=since, until=until)
+    else:
+        periods = {}
+        for day, buckets in days.items():
+            period = datetime.strptime(day, '%Y-%m-%d').strftime(PERIOD_FORMATS[split])
+            periods.setdefault(period, {})[day] = buckets
+        report = {period: summarize_buckets(merge_daily_buckets(periods[period]), participants) for period in sorted(periods)}
 
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    print(f"Report for {len(days)} days saved to '{output_file}'.")
 
-                gift = "A Boxing Glove (for our next debate)"
+# --- SHARDED (MAP/REDUCE) ANALYSIS ---
+# A partial aggregate holds everything analyze_messages needs, in a form that can be
+# saved as JSON and merged with the partials of other exports or shards.
 
+PARTIAL_FORMAT_VERSION = 6
 
-            elif sender_profile.get('reading_level', {}).get('grade_level', 0) > 12:
+def new_participant_partial():
+    """
+    Returns the empty per-participant state of a partial aggregate.
+    """
+    return {
+        'message_count': 0,
+        'word_counts': Counter(),
+        'vocabulary': vocabulary_to_dict(new_vocabulary()),
+        'emoji_counts': Counter(),
+        'sentiment': new_sentiment_tally(),
+        'readability': {'words': 0, 'sentences': 0, 'syllables': 0, 'difficult_words': 0},
+        'excuse_counts': Counter(),
+        'pos_counts': {'adjectives': 0, 'verbs': 0, 'nouns': 0},
+        'self_pronoun_counts': Counter(),
+        'night_owl': 0,
+        'questions': 0,
+        'mentions': 0
+    }
 
+def new_interaction_partial():
+    """
+    Returns the empty state of one sender -> receiver interaction in a partial aggregate.
+    """
+    return {'message_count': 0, 'sentiment': new_sentiment_tally(), 'emoji_counts': Counter(), 'word_counts': Counter()}
 
-                gift = "A Book Recommendation"
+def build_partial(messages, participants=None, media_root=None, chat=None):
+    """
+    Map step: computes the partial aggregate of one export or shard of the chat
+    named chat. If participants is given, only messages sent by them are analyzed.
+    """
+    messages, exact_duplicates = remove_exact_duplicates(compact_messages(messages))
+    text_messages, reaction_notices = prepare_messages(messages)
+    if participants:
+        selected = set(participants)
+        text_messages = [msg for msg in text_messages if msg.sender_name in selected]
+        reaction_notices = [notice for notice in reaction_notices if notice['sender_name'] in selected]
 
+    # Sort messages by timestamp
+    text_messages.sort(key=lambda x: x.timestamp_ms)
+    text_messages, copypasta_clusters, near_duplicates = find_copypasta(text_messages)
+    # Sketches cannot drop words later, so participant names are left out of the vocabulary
+    # here; only the names of the selected participants and this shard's senders are known.
+    vocabulary_names = get_participant_name_words(set(participants or ()) | set(msg.sender_name for msg in text_messages))
+    # As in run_analysis, senders whose only messages were copypasta are left out
+    participants = sorted(set(msg.sender_name for msg in text_messages))
+
+    stop_words = get_stop_words()
+    compounds = get_sentiment_scorer().compound_scores([msg.content for msg in text_messages])
+    mention_pattern = build_mention_pattern(participants)
+    interaction_pattern = build_interaction_pattern(participants)
+    threshold_ms = CONVERSATION_THRESHOLD_HOURS * 3600 * 1000
+
+    by_participant = {name: new_participant_partial() for name in participants}
+    texts = {name: [] for name in participants}
+    vocabularies = {name: new_vocabulary() for name in participants}
+    interactions = {}
+    initiators = Counter()
+    max_gap_ms = None if MONOLOGUE_MAX_GAP_MINUTES is None else MONOLOGUE_MAX_GAP_MINUTES * 60 * 1000
+    top_runs = {}
+    first_run = None
+    run = None
+    last_timestamp = None
+
+    for index, (msg, compound) in enumerate(zip(text_messages, compounds)):
+        name = msg.sender_name
+        content = msg.content
+        timestamp = msg.timestamp_ms
+        stats = by_participant[name]
+        stats['message_count'] += 1
+        texts[name].append(content)
+
+        words = get_content_words(content, stop_words)
+        emojis = [emj['emoji'] for emj in emoji.emoji_list(content)]
+        stats['word_counts'].update(words)
+        add_vocabulary(vocabularies[name], [word for word in words if word not in vocabulary_names], timestamp)
+        stats['emoji_counts'].update(emojis)
+        add_sentiment(stats['sentiment'], content, compound)
+        add_pos_counts(stats['pos_counts'], content)
+        for token in re.findall(r'\b\w+\b', content.lower()):
+            if token in EXCUSE_WORDS:
+                stats['excuse_counts'][token] += 1
+            if token in SELF_PRONOUNS:
+                stats['self_pronoun_counts'][token] += 1
+
+        hour = datetime.fromtimestamp(timestamp / 1000).hour
+        if hour >= NIGHT_START_HOUR or hour < NIGHT_END_HOUR:
+            stats['night_owl'] += 1
+        if '?' in content:
+            stats['questions'] += 1
+        for mentioned in get_mentioned_participants(content, participants, mention_pattern):
+            by_participant[mentioned]['mentions'] += 1
+
+        for receiver in get_mentioned_receivers(name, content, participants, interaction_pattern):
+            pair = interactions.setdefault(name, {}).setdefault(receiver, new_interaction_partial())
+            pair['message_count'] += 1
+            add_sentiment(pair['sentiment'], content, compound)
+            pair['emoji_counts'].update(emojis)
+            pair['word_counts'].update(words)
+
+        # The first message of the shard is counted when partials are merged
+        if last_timestamp is not None and timestamp - last_timestamp > threshold_ms:
+            initiators[name] += 1
+        last_timestamp = timestamp
+
+        if run is None or not extend_monologue_run(run, msg, max_gap_ms):
+            if run is not None:
+                keep_top_run(top_runs, run, MONOLOGUE_TOP_K)
+            run = start_monologue_run(index, msg)
+            if first_run is None:
+                first_run = run
+    if run is not None:
+        keep_top_run(top_runs, run, MONOLOGUE_TOP_K)
+
+    # Offsets are only meaningful within this shard, so candidate runs keep their preview instead
+    monologues = {'first': first_run, 'last': run, 'best': {author: ranked_runs(heap) for author, heap in top_runs.items()}}
+    for candidate in [first_run, run] + [r for runs in monologues['best'].values() for r in runs]:
+        if candidate is not None and 'start' in candidate:
+            candidate['preview'] = monologue_preview(text_messages, candidate)
+            del candidate['start']
 
-            
+    for name in participants:
+        add_readability(by_participant[name]['readability'], ". ".join(texts[name]))
+        by_participant[name]['vocabulary'] = vocabulary_to_dict(vocabularies[name])
 
+    return {
+        'version': PARTIAL_FORMAT_VERSION,
+        'chats': [chat],
+        'participants': participants,
+        'message_count': len(text_messages),
+        'first_timestamp': text_messages[0].timestamp_ms if text_messages else None,
+        'last_timestamp': text_messages[-1].timestamp_ms if text_messages else None,
+        'first_sender': text_messages[0].sender_name if text_messages else None,
+        'last_sender': text_messages[-1].sender_name if text_messages else None,
+        'by_participant': by_participant,
+        'interactions': interactions,
+        'initiators': initiators,
+        'monologues': monologues,
+        'reply_latency': digests_to_dict(collect_reply_latency(text_messages, participants)),
+        'reactions': reactions_to_dict(collect_reactions(messages, reaction_notices, participants)),
+        'media': get_media_stats(messages, participants, media_root),
+        'duplicates': {'exact': exact_duplicates, 'near': near_duplicates},
+        'copypasta_clusters': copypasta_clusters
+    }
 
-            # --- Greeting & Blessing Logic ---
+def add_readability(readability, text):
+    """
+    Adds the counts behind the Flesch-Kincaid and Dale-Chall formulas for a block of text.
+    """
+    if not text.strip():
+        return
+    readability['words'] += textstat.lexicon_count(text)
+    readability['sentences'] += textstat.sentence_count(text)
+    readability['syllables'] += textstat.syllable_count(text)
+    readability['difficult_words'] += textstat.difficult_words(text, syllable_threshold=0, unique=False)
 
+def summarize_readability(readability):
+    """
+    Computes the reading level from summed readability counts, using the same
+    formulas as textstat.
+    """
+    words = readability['words']
+    sentences = readability['sentences']
+    if words == 0 or sentences == 0:
+        return {
+            'grade_level': 0,
+            'dale_chall': 0,
+            'interpretation': 'No text to analyze.'
+        }
 
-            greeting = f"Merry Christmas, {receiver.split()[0]}!"
+    words_per_sentence = words / sentences
+    syllables_per_word = readability['syllables'] / words
+    grade_level = (0.39 * words_per_sentence) + (11.8 * syllables_per_word) - 15.59 if syllables_per_word else 0
+    difficult_percent = 100 * readability['difficult_words'] / words
+    dale_chall = (0.1579 * difficult_percent) + (0.0496 * words_per_sentence)
+    if difficult_percent > 5:
+        dale_chall += 3.6365
+    return format_reading_level(grade_level, dale_chall)
 
+def digests_to_dict(digests):
+    """
+    Converts nested dicts of TDigests to plain dicts for JSON.
+    """
+    return {key: digests_to_dict(value) if isinstance(value, dict) else value.to_dict() for key, value in digests.items()}
 
-            blessing = "Wishing you all the best this holiday season."
+def digests_from_dict(data):
+    """
+    Rebuilds nested dicts of TDigests saved with digests_to_dict.
+    """
+    return {key: TDigest.from_dict(value) if 'compression' in value else digests_from_dict(value) for key, value in data.items()}
 
+def reactions_to_dict(state):
+    """
+    Converts collected reaction statistics to plain dicts for JSON.
+    """
+    return dict(state, latency=digests_to_dict(state['latency']))
 
+def merge_counts(a, b):
+    """
+    Adds two count dicts together.
+    """
+    merged = Counter(a)
+    merged.update(b)
+    return merged
 
+def merge_sentiment(a, b):
+    """
+    Merges two sentiment tallies. On a tie the example of the earlier tally is kept.
+    """
+    return {
+        'pos': a['pos'] + b['pos'],
+        'neu': a['neu'] + b['neu'],
+        'neg': a['neg'] + b['neg'],
+        'most_positive': b['most_positive'] if b['most_positive'][1] > a['most_positive'][1] else a['most_positive'],
+        'most_negative': b['most_negative'] if b['most_negative'][1] < a['most_negative'][1] else a['most_negative']
+    }
 
+def merge_participant_partials(a, b):
+    """
+    Merges the per-participant state of two partial aggregates.
+    """
+    return {
+        'message_count': a['message_count'] + b['message_count'],
+        'word_counts': merge_counts(a['word_counts'], b['word_counts']),
+        'vocabulary': vocabulary_to_dict(merge_vocabulary(vocabulary_from_dict(a['vocabulary']), vocabulary_from_dict(b['vocabulary']))),
+        'emoji_counts': merge_counts(a['emoji_counts'], b['emoji_counts']),
+        'sentiment': merge_sentiment(a['sentiment'], b['sentiment']),
+        'readability': {key: a['readability'][key] + b['readability'][key] for key in a['readability']},
+        'excuse_counts': merge_counts(a['excuse_counts'], b['excuse_counts']),
+        'pos_counts': {key: a['pos_counts'][key] + b['pos_counts'][key] for key in a['pos_counts']},
+        'self_pronoun_counts': merge_counts(a['self_pronoun_counts'], b['self_pronoun_counts']),
+        'night_owl': a['night_owl'] + b['night_owl'],
+        'questions': a['questions'] + b['questions'],
+        'mentions': a['mentions'] + b['mentions']
+    }
 
-            # If sender is very positive in general
+def merge_interaction_partials(a, b):
+    """
+    Merges the state of one sender -> receiver interaction from two partial aggregates.
+    """
+    return {
+        'message_count': a['message_count'] + b['message_count'],
+        'sentiment': merge_sentiment(a['sentiment'], b['sentiment']),
+        'emoji_counts': merge_counts(a['emoji_counts'], b['emoji_counts']),
+        'word_counts': merge_counts(a['word_counts'], b['word_counts'])
+    }
 
+def merge_nested(a, b, merge_values):
+    """
+    Merges two dicts, combining the values present in both with merge_values.
+    """
+    merged = dict(a)
+    for key, value in b.items():
+        merged[key] = merge_values(merged[key], value) if key in merged else value
+    return merged
 
-            if sender_profile.get('sentiment', {}).get('positive_percent', 0) > 70:
+def join_monologue_runs(a, b):
+    """
+    Returns the run made of run a followed by run b, or None if b does not continue a.
+    """
+    gap = b['start_timestamp'] - a['end_timestamp']
+    if a['author'] != b['author'] or (MONOLOGUE_MAX_GAP_MINUTES is not None and gap > MONOLOGUE_MAX_GAP_MINUTES * 60 * 1000):
+        return None
+    joined = {
+        'author': a['author'],
+        'message_count': a['message_count'] + b['message_count'],
+        'start_timestamp': a['start_timestamp'],
+        'end_timestamp': b['end_timestamp'],
+        'interval_total': a['interval_total'] + b['interval_total'],
+        'interval_min': min((x for x in (a['interval_min'], b['interval_min']) if x is not None), default=None),
+        'interval_max': max((x for x in (a['interval_max'], b['interval_max']) if x is not None), default=None),
+        'preview': a['preview'] + b['preview'] if MONOLOGUE_PREVIEW_MESSAGES is None else (a['preview'] + b['preview'])[:MONOLOGUE_PREVIEW_MESSAGES]
+    }
+    add_monologue_interval(joined, gap)
+    return joined
 
+def merge_monologues(a, b, stitch=True):
+    """
+    Merges the monologue state of two partials. If stitch is set (b continues the
+    chat of a), a run that continues across the boundary between them is stitched
+    together and replaces its two halves.
+    """
+    if a['first'] is None:
+        return b
+    if b['first'] is None:
+        return a
+
+    best = merge_nested(a['best'], b['best'], lambda x, y: x + y)
+    first, last = a['first'], b['last']
+    joined = join_monologue_runs(a['last'], b['first']) if stitch else None
+    if joined is not None:
+        author = joined['author']
+        best[author] = [run for run in best.get(author, []) if run != a['last'] and run != b['first']] + [joined]
+        # A partial made of a single run starts and ends with the joined run
+        if a['first'] == a['last']:
+            first = joined
+        if b['first'] == b['last']:
+            last = joined
+    best = {author: heapq.nlargest(MONOLOGUE_TOP_K, runs, key=monologue_rank) for author, runs in best.items()}
+    return {'first': first, 'last': last, 'best': best}
+
+def can_stitch_partials(a, b):
+    """
+    Returns whether b continues the chat right where a ends: both are shards of the
+    same single chat and b starts no earlier than a ends.
+    """
+    if a['last_timestamp'] is None or b['first_timestamp'] is None:
+        return False
+    return len(a['chats']) == 1 and a['chats'] == b['chats'] and b['first_timestamp'] >= a['last_timestamp']
 
-                greeting += " Hope you have a wonderful time! 🎄"
+def merge_two_partials(a, b):
+    """
+    Merges two partial aggregates. If b continues the chat of a (see
+    can_stitch_partials), conversations and monologues are stitched across the
+    boundary; otherwise b's first message starts a new conversation.
+    """
+    initiators = merge_counts(a['initiators'], b['initiators'])
+    reply_latency = merge_nested(digests_from_dict(a['reply_latency']), digests_from_dict(b['reply_latency']), lambda x, y: merge_nested(x, y, lambda p, q: p.merge(q)))
+    stitch = can_stitch_partials(a, b)
+    if stitch:
+        # Stitch the boundary: a new conversation or a reply across the two shards
+        gap = b['first_timestamp'] - a['last_timestamp']
+        if gap > CONVERSATION_THRESHOLD_HOURS * 3600 * 1000:
+            initiators[b['first_sender']] += 1
+        elif b['first_sender'] != a['last_sender']:
+            pair = reply_latency.setdefault(a['last_sender'], {}).setdefault(b['first_sender'], TDigest())
+            pair.add(gap / 1000)
+    elif a['first_sender'] is not None and b['first_sender'] is not None:
+        # The first message of the whole merge is counted when the partial is finalized
+        initiators[b['first_sender']] += 1
+
+    reactions = {
+        'given': merge_nested(a['reactions']['given'], b['reactions']['given'], merge_counts),
+        'received': merge_nested(a['reactions']['received'], b['reactions']['received'], merge_counts),
+        'reactor_to_author': merge_nested(a['reactions']['reactor_to_author'], b['reactions']['reactor_to_author'], merge_counts),
+        'latency': digests_to_dict(merge_nested(digests_from_dict(a['reactions']['latency']), digests_from_dict(b['reactions']['latency']), lambda x, y: x.merge(y))),
+        'latency_total': merge_counts(a['reactions']['latency_total'], b['reactions']['latency_total']),
+        'most_reacted': heapq.nlargest(max(len(a['reactions']['most_reacted']), len(b['reactions']['most_reacted'])), a['reactions']['most_reacted'] + b['reactions']['most_reacted'], key=lambda item: (item[0], item[1]))
+    }
 
+    has_a = a['first_timestamp'] is not None
+    has_b = b['first_timestamp'] is not None
+    return {
+        'version': PARTIAL_FORMAT_VERSION,
+        'chats': sorted(set(a['chats']) | set(b['chats']), key=str),
+        'participants': sorted(set(a['participants']) | set(b['participants'])),
+        'message_count': a['message_count'] + b['message_count'],
+        'first_timestamp': a['first_timestamp'] if has_a else b['first_timestamp'],
+        'last_timestamp': b['last_timestamp'] if has_b else a['last_timestamp'],
+        'first_sender': a['first_sender'] if has_a else b['first_sender'],
+        'last_sender': b['last_sender'] if has_b else a['last_sender'],
+        'by_participant': merge_nested(a['by_participant'], b['by_participant'], merge_participant_partials),
+        'interactions': merge_nested(a['interactions'], b['interactions'], lambda x, y: merge_nested(x, y, merge_interaction_partials)),
+        'initiators': initiators,
+        'monologues': merge_monologues(a['monologues'], b['monologues'], stitch),
+        'reply_latency': digests_to_dict(reply_latency),
+        'reactions': reactions,
+        'media': merge_nested(a['media'], b['media'], lambda x, y: {key: x[key] + y[key] for key in x}),
+        'duplicates': {key: a['duplicates'][key] + b['duplicates'][key] for key in a['duplicates']},
+        'copypasta_clusters': merge_copypasta_clusters(a['copypasta_clusters'] + b['copypasta_clusters'])
+    }
 
-                blessing = "May your Christmas sparkle with moments of love, laughter, and goodwill!"
+def merge_partials(partials):
+    """
+    Reduce step: merges partial aggregates into one.
+    The shards of each chat are merged in the order of their first message, and
+    conversations and monologues are stitched across their boundaries, which is
+    exact when the shards cover consecutive time ranges. Shards of one chat that
+    overlap in time are not stitched. The chats are then combined without stitching.
+    Reaction notices are only paired with reacted messages from the same shard.
+    """
+    ordered = sorted(partials, key=lambda p: (p['first_timestamp'] is None, p['first_timestamp'] or 0))
+    chats = {}
+    for partial in ordered:
+        chats.setdefault(tuple(partial['chats']), []).append(partial)
+
+    merged = None
+    for shards in chats.values():
+        merged_chat = shards[0]
+        for partial in shards[1:]:
+            merged_chat = merge_two_partials(merged_chat, partial)
+        merged = merged_chat if merged is None else merge_two_partials(merged, merged_chat)
+    return merged
+
+def finalize_partial(partial, stream_greetings=False):
+    """
+    Turns a (merged) partial aggregate into the advanced_analysis.json structure.
+    With stream_greetings, the greetings are left as an iterator as in run_analysis.
+    """
+    participants = partial['participants']
+    by_participant = {name: partial['by_participant'].get(name) or new_participant_partial() for name in participants}
 
+    analysis_by_participant = {}
+    for name in participants:
+        stats = by_participant[name]
+        most_common, custom_counts = summarize_word_counts(stats['word_counts'], participants)
+        analysis_by_participant[name] = {
+            'most_common_words': most_common,
+            'vocabulary_richness': summarize_vocabulary(vocabulary_from_dict(stats['vocabulary'])),
+            'custom_word_counts': custom_counts,
+            'reading_level': summarize_readability(stats['readability']),
+            'sentiment': summarize_sentiment(stats['sentiment']),
+            'emoji_usage': Counter(stats['emoji_counts']).most_common(5),
+            'excuse_factor': {word: stats['excuse_counts'].get(word, 0) for word in EXCUSE_WORDS},
+            'pos_counts': stats['pos_counts'],
+            'self_pronoun_counts': {pronoun: stats['self_pronoun_counts'].get(pronoun, 0) for pronoun in SELF_PRONOUNS}
+        }
 
-            
+    overall_emojis = Counter()
+    for stats in by_participant.values():
+        overall_emojis.update(stats['emoji_counts'])
 
+    initiators = Counter(partial['initiators'])
+    if partial['first_sender'] is not None:
+        # First message in the entire chat is always an initiator
+        initiators[partial['first_sender']] += 1
 
-            # If sender is very positive specifically towards the receiver
 
+    reply_digests = digests_from_dict(partial['reply_latency'])
+    for sender in participants:
+        reply_digests.setdefault(sender, {})
+        for responder in participants:
+            if responder != sender:
+                reply_digests[sender].setdefault(responder, TDigest())
 
-            if interaction.get('sentiment', {}).get('positive_percent', 0) > 70:
+    reactions = dict(partial['reactions'], latency=digests_from_dict(partial['reactions']['latency']))
 
+    interaction_analysis = {}
+    for sender in participants:
+        interaction_analysis[sender] = {}
+        for receiver in participants:
+            if sender == receiver:
+                continue
+            pair = partial['interactions'].get(sender, {}).get(receiver)
+            if not pair or not pair['message_count']:
+                interaction_analysis[sender][receiver] = {
+                    'message_count': 0,
+                    'sentiment': {'pos': 0, 'neu': 0, 'neg': 0},
+                    'emojis': [],
+                    'common_words': []
+                }
+                continue
+            interaction_analysis[sender][receiver] = {
+                'message_count': pair['message_count'],
+                'sentiment': summarize_sentiment(pair['sentiment']),
+                'emojis': Counter(pair['emoji_counts']).most_common(3),
+                'common_words': summarize_word_counts(pair['word_counts'], participants)[0][:5]
+            }
 
-                emojis_to_receiver = ''.join([e[0] for e in interaction.get('emojis', [])])
+    overall_analysis = {
+        'top_emojis': overall_emojis.most_common(5),
+        'chat_initiator': initiators.most_common(),
+        'night_owl_score': sorted(((name, by_participant[name]['night_owl']) for name in participants), key=lambda item: item[1], reverse=True),
+        'longest_monologues_per_participant': summarize_monologues(partial['monologues']['best'], participants),
+        'question_askers': sorted(((name, by_participant[name]['questions']) for name in participants), key=lambda item: item[1], reverse=True),
+        'special_mentions': sorted(((name, by_participant[name]['mentions']) for name in participants), key=lambda item: item[1], reverse=True),
+        'reply_latency': summarize_reply_latency(reply_digests),
+        'reaction_analysis': summarize_reactions(reactions, participants),
+        'media_analysis': summarize_media_stats({name: partial['media'].get(name) or new_media_stats() for name in participants}),
+        'copypasta': summarize_copypasta(partial['copypasta_clusters'], partial['duplicates']['exact'], partial['duplicates']['near']),
+        'interaction_analysis': interaction_analysis
+    }
 
+    final_output = {
+        'participants': participants,
+        'analysis_by_participant': analysis_by_participant,
+        'overall_analysis': overall_analysis,
+    }
+    greetings = iter_inter_participant_greetings if stream_greetings else generate_inter_participant_greetings
+    final_output['inter_participant_christmas_greetings'] = greetings(interaction_analysis, final_output)
+    return final_output
 
-                greeting = f"To my dear {receiver.split()[0]}, Merry Christmas! {emojis_to_receiver}"
+def default_chat_name(input_file):
+    """
+    Names the chat of an export or shard: the export folder for a folder or one of
+    its message_*.json files, otherwise the file name without its extension.
+    """
+    path = os.path.abspath(input_file)
+    if os.path.isdir(path):
+        return os.path.basename(os.path.normpath(path))
+    if re.fullmatch(r'message_\d+\.json', os.path.basename(path)):
+        return os.path.basename(os.path.dirname(path))
+    return os.path.splitext(os.path.basename(path))[0]
+
+def map_export(input_file, output_file, participants=None, media_root=None, chat=None):
+    """
+    Map step CLI: writes the partial aggregate of one export or shard to output_file.
+    Shards are only stitched together when reduced if they have the same chat name,
+    which defaults to default_chat_name(input_file).
+    """
+    print(f"Building partial aggregate for '{input_file}'...")
+    messages = load_messages(input_file)
+    if messages is None:
+        return
+    partial = build_partial(messages, participants, media_root, chat or default_chat_name(input_file))
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(partial, f)
+    print(f"Partial aggregate of {partial['message_count']} text messages saved to '{output_file}'.")
 
+def reduce_partials(partial_files, output_file):
+    """
+    Reduce step CLI: merges partial aggregate files into advanced_analysis.json.
+    """
+    print(f"Merging {len(partial_files)} partial aggregates...")
+    partials = []
+    for path in partial_files:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                partial = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            print(f"ERROR: Could not read partial aggregate '{path}'. Details: {e}")
+            return
+        if partial.get('version') != PARTIAL_FORMAT_VERSION:
+            print(f"ERROR: '{path}' was written by an incompatible version of this script.")
+            return
+        partials.append(partial)
+
+    final_output = finalize_partial(merge_partials(partials), stream_greetings=True)
+    with open(output_file, 'w', encoding='utf-8') as f:
+        write_analysis(final_output, f)
 
-                blessing = "So grateful for you this holiday season! Hope you have the best time."
+    print(f"\nMerged analysis complete! Results saved to '{output_file}'.")
 
+if __name__ == '__main__':
 
 
+    parser = argparse.ArgumentParser(description='Run advanced analysis on chat messages.')
 
 
-            greetings[sender][receiver] = {
+    parser.add_argument('-i', '--input', default='filtered_messages.json', help='Input JSON file')
 
 
-                'greeting': greeting,
+    parser.add_argument('-o', '--output', default=None, help='Output JSON file (default: advanced_analysis.json, <input>.partial.json with --map, or report.json with --report)')
 
 
-                'blessing': blessing,
+    parser.add_argument('--map', action='store_true', help='Only write the partial aggregate of the input (an export file or folder) for a later --reduce')
 
 
-                'gift': gift
+    parser.add_argument('--reduce', nargs='+', metavar='PARTIAL', help='Merge partial aggregate files written by --map into the output')
 
 
-            }
+    parser.add_argument('--participants', nargs='+', help='With --map, only analyze messages sent by these participants')
 
 
-            
+    parser.add_argument('--chat', default=None, help='With --map, name of the chat the input belongs to; give all shards of one chat the same name (default: the export folder or file name)')
 
 
-    return greetings
+    parser.add_argument('--media-root', default=None, help='Export folder the attachment URIs are relative to; enables media sizes and durations')
 
 
+    parser.add_argument('--buckets', default=None, help='Day buckets file written by the analysis and read by --report (default: <output>.buckets.json, or advanced_analysis.buckets.json with --report)')
 
 
+    parser.add_argument('--report', action='store_true', help='Write word, emoji, sentiment, night owl, question and mention results for a date range from saved day buckets')
 
-if __name__ == '__main__':
 
+    parser.add_argument('--since', default=None, help='With --report, first day to include (YYYY-MM-DD)')
 
-    parser = argparse.ArgumentParser(description='Run advanced analysis on chat messages.')
 
+    parser.add_argument('--until', default=None, help='With --report, last day to include (YYYY-MM-DD)')
 
-    parser.add_argument('-i', '--input', default='filtered_messages.json', help='Input JSON file')
 
+    parser.add_argument('--split', choices=list(PERIOD_FORMATS), help='With --report, write one report per day, month or year')
 
-    parser.add_argument('-o', '--output', default='advanced_analysis.json', help='Output JSON file')
 
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help=f'Folder for cached stage results (default: {CACHE_DIR})')
 
-    args = parser.parse_args()
 
+    parser.add_argument('--cache-size-mb', type=int, default=CACHE_MAX_MB, help=f'Size limit of the stage cache in MB (default: {CACHE_MAX_MB})')
 
 
+    parser.add_argument('--no-cache', action='store_true', help='Recompute every stage without reading or writing the cache')
 
 
-    # Download NLTK data if not already present
+    parser.add_argument('--sample', type=float, default=None, metavar='FRACTION', help='Quick preview: analyze this fraction (e.g. 0.05) of each sender\'s messages per month and add 95%% confidence intervals')
 
 
-    try:
+    args = parser.parse_args()
 
 
-        nltk.data.find('corpora/vader_lexicon')
+    if args.sample is not None and not 0 < args.sample <= 1:
 
 
-    except LookupError:
+        parser.error('--sample must be a fraction between 0 and 1')
 
 
-        print("Downloading NLTK VADER lexicon...")
+    if args.output is None:
 
 
-        nltk.download('vader_lexicon')
+        if args.map:
 
 
-    
+            args.output = os.path.splitext(os.path.basename(os.path.normpath(args.input)))[0] + '.partial.json'
 
 
-    try:
+        elif args.report:
 
 
-        nltk.data.find('corpora/stopwords')
+            args.output = 'report.json'
 
 
-    except LookupError:
+        else:
 
 
-        print("Downloading NLTK stopwords...")
+            args.output = 'advanced_analysis.json'
 
 
-        nltk.download('stopwords')
+    if args.buckets is None:
 
 
+        args.buckets = 'advanced_analysis.buckets.json' if args.report else os.path.splitext(args.output)[0] + '.buckets.json'
 
 
 
-    try:
 
 
-        nltk.data.find('taggers/averaged_perceptron_tagger')
+    # Download NLTK data if not already present
 
 
-    except LookupError:
+    ensure_nltk_data()
 
 
-        print("Downloading NLTK averaged_perceptron_tagger...")
 
 
-        nltk.download('averaged_perceptron_tagger')
 
+    if args.map:
 
-    
 
+        map_export(args.input, args.output, args.participants, args.media_root, args.chat)
 
-    try:
 
+    elif args.reduce:
 
-        nltk.data.find('tokenizers/punkt')
 
+        reduce_partials(args.reduce, args.output)
 
-    except LookupError:
 
+    elif args.report:
 
-        print("Downloading NLTK punkt tokenizer...")
 
+        report_date_range(args.buckets, args.output, args.since, args.until, args.split)
 
-        nltk.download('punkt')
 
+    else:
 
 
+        cache = StageCache(None if args.no_cache else args.cache_dir, args.cache_size_mb * 1024 * 1024)
 
 
-    analyze_messages(args.input, args.output)
+        analyze_messages(args.input, args.output, args.media_root, args.buckets, args.sample, cache)
 
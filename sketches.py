@@ -0,0 +1,346 @@
+import base64
+import functools
+import hashlib
+import heapq
+import math
+import random
+import zlib
+
+import numpy as np
+
+# --- STREAMING SKETCHES ---
+# Small, mergeable summaries used by the analysis scripts when keeping every
+# value around would cost memory proportional to the size of the chat export.
+
+
+class TDigest:
+    """
+    A merging t-digest (Dunning & Ertl) for estimating quantiles of a stream.
+    Memory is bounded by the compression parameter, and two digests can be
+    merged, so partial results from different chunks of a chat can be combined.
+    """
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self._buffer = []
+
+    def add(self, value, weight=1):
+        """
+        Adds a value to the digest.
+        """
+        self._buffer.append((value, weight))
+        self.count += weight
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if len(self._buffer) >= self.compression * 5:
+            self._compress()
+
+    def merge(self, other):
+        """
+        Merges another digest into this one.
+        """
+        other._compress()
+        self._buffer.extend(zip(other.means, other.weights))
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+        return self
+
+    def _scale(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0), 1) - 1)
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        points = sorted(list(zip(self.means, self.weights)) + self._buffer)
+        self._buffer = []
+        total = self.count
+
+        means = []
+        weights = []
+        cumulative = 0
+        current_mean, current_weight = points[0]
+        k_lower = self._scale(0)
+        for mean, weight in points[1:]:
+            q_upper = (cumulative + current_weight + weight) / total
+            if self._scale(q_upper) - k_lower <= 1:
+                # Fold the point into the current centroid
+                current_weight += weight
+                current_mean += (mean - current_mean) * weight / current_weight
+            else:
+                means.append(current_mean)
+                weights.append(current_weight)
+                cumulative += current_weight
+                k_lower = self._scale(cumulative / total)
+                current_mean, current_weight = mean, weight
+        means.append(current_mean)
+        weights.append(current_weight)
+
+        self.means = means
+        self.weights = weights
+
+    def quantile(self, q):
+        """
+        Estimates the value at quantile q (0 <= q <= 1), or None if the digest is empty.
+        """
+        self._compress()
+        if not self.means:
+            return None
+        if len(self.means) == 1:
+            return self.means[0]
+
+        target = q * self.count
+        # Each centroid is treated as sitting at the middle of its weight
+        cumulative = 0
+        previous_center, previous_mean = 0, self.min
+        for mean, weight in zip(self.means, self.weights):
+            center = cumulative + weight / 2
+            if target <= center:
+                if center == previous_center:
+                    return mean
+                fraction = (target - previous_center) / (center - previous_center)
+                return previous_mean + (mean - previous_mean) * fraction
+            previous_center, previous_mean = center, mean
+            cumulative += weight
+        if self.count == previous_center:
+            return self.max
+        fraction = (target - previous_center) / (self.count - previous_center)
+        return previous_mean + (self.max - previous_mean) * fraction
+
+    def to_dict(self):
+        """
+        Returns a JSON-serializable representation of the digest.
+        """
+        self._compress()
+        return {
+            'compression': self.compression,
+            'means': self.means,
+            'weights': self.weights,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Rebuilds a digest from the output of to_dict.
+        """
+        digest = cls(data['compression'])
+        digest.means = list(data['means'])
+        digest.weights = list(data['weights'])
+        digest.count = sum(digest.weights)
+        if digest.count:
+            digest.min = data['min']
+            digest.max = data['max']
+        return digest
+
+
+# Mersenne prime used for the MinHash permutations
+MERSENNE_PRIME = (1 << 61) - 1
+
+class MinHasher:
+    """
+    Computes MinHash signatures of sets of strings. The fraction of positions where
+    two signatures agree estimates the Jaccard similarity of the two sets.
+    Hashers created with the same num_perm and seed produce comparable signatures,
+    also across processes.
+    """
+
+    def __init__(self, num_perm=64, seed=1):
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME)) for _ in range(num_perm)]
+        # a * h does not fit in 64 bits, so a is split into a 31-bit low and a 30-bit high half
+        a = np.array([a for a, _ in self.permutations], dtype=np.uint64)
+        self._a_low = (a & np.uint64((1 << 31) - 1))[:, None]
+        self._a_high = (a >> np.uint64(31))[:, None]
+        self._b = np.array([b for _, b in self.permutations], dtype=np.uint64)[:, None]
+
+    def signature(self, shingles):
+        """
+        Returns the MinHash signature (a list of num_perm ints) of a non-empty set of strings.
+        """
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+        # (a * h + b) mod p for every permutation and shingle at once, exactly as in integer arithmetic:
+        # a * h = a_high * h * 2^31 + a_low * h, and multiplying by 2^31 mod p rotates the 61 bits.
+        high = mod_mersenne(self._a_high * hashes)
+        high = mod_mersenne(((high & np.uint64((1 << 30) - 1)) << np.uint64(31)) | (high >> np.uint64(30)))
+        values = mod_mersenne(mod_mersenne(self._a_low * hashes) + high + self._b)
+        return values.min(axis=1).tolist()
+
+def mod_mersenne(x):
+    """
+    Reduces a uint64 array below 2^63 modulo MERSENNE_PRIME.
+    """
+    p = np.uint64(MERSENNE_PRIME)
+    x = (x & p) + (x >> np.uint64(61))
+    return np.where(x >= p, x - p, x)
+
+def estimate_jaccard(signature_a, signature_b):
+    """
+    Estimates the Jaccard similarity of two sets from their MinHash signatures.
+    """
+    return sum(1 for x, y in zip(signature_a, signature_b) if x == y) / len(signature_a)
+
+def lsh_clusters(signatures, bands, threshold):
+    """
+    Groups similar signatures with locality-sensitive hashing: signatures are split
+    into bands and only signatures sharing a band are compared, so there is never a
+    pairwise comparison of everything. Returns the groups of two or more indices whose
+    estimated similarity to a group member is at least threshold, each sorted.
+    """
+    parents = list(range(len(signatures)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    rows = len(signatures[0]) // bands if signatures else 0
+    for band in range(bands):
+        buckets = {}
+        for index, signature in enumerate(signatures):
+            key = tuple(signature[band * rows:(band + 1) * rows])
+            first = buckets.setdefault(key, index)
+            if first != index and find(first) != find(index) and estimate_jaccard(signatures[first], signature) >= threshold:
+                # Keep the lowest index as the root of each group
+                root_a, root_b = find(first), find(index)
+                parents[max(root_a, root_b)] = min(root_a, root_b)
+
+    groups = {}
+    for index in range(len(signatures)):
+        groups.setdefault(find(index), []).append(index)
+    return [members for members in groups.values() if len(members) > 1]
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def hash64(value):
+    """
+    Returns a 64-bit hash of a string that is the same in every process.
+    """
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+class HyperLogLog:
+    """
+    A HyperLogLog sketch (Flajolet et al.) for estimating the number of distinct
+    strings in a stream. It uses 2^precision one-byte registers whatever the size of
+    the stream, with a relative error of about 1.04 / sqrt(2^precision). Sketches of
+    the same precision can be merged to count the distinct values of their union.
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        """
+        Adds a string to the sketch.
+        """
+        hashed = hash64(value)
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        # Position of the first set bit in the remaining bits
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """
+        Merges another sketch of the same precision into this one.
+        """
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLog sketches of different precisions.")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        """
+        Estimates the number of distinct values added to the sketch.
+        """
+        m = len(self.registers)
+        zeros = self.registers.count(0)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -register for register in self.registers)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small counts
+            return m * math.log(m / zeros)
+        return estimate
+
+    def to_dict(self):
+        """
+        Returns a JSON-serializable representation of the sketch.
+        """
+        return {
+            'precision': self.precision,
+            'registers': base64.b64encode(zlib.compress(bytes(self.registers))).decode('ascii')
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Rebuilds a sketch from the output of to_dict.
+        """
+        sketch = cls(data['precision'])
+        sketch.registers = bytearray(zlib.decompress(base64.b64decode(data['registers'])))
+        return sketch
+
+class DistinctSample:
+    """
+    A uniform sample of the distinct strings of a stream: the size values with the
+    smallest hashes, with the exact number of times each was added. A value that ends
+    up in the sample is in it from its first occurrence, so its count is exact.
+    Samples of the same size can be merged.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.counts = {}
+        self._heap = [] # (-hash, value) of the sampled values, largest hash first
+
+    def add(self, value, count=1):
+        """
+        Adds count occurrences of a string to the sample.
+        """
+        if value in self.counts:
+            self.counts[value] += count
+            return
+        hashed = hash64(value)
+        if len(self.counts) < self.size:
+            heapq.heappush(self._heap, (-hashed, value))
+        elif hashed < -self._heap[0][0]:
+            _, evicted = heapq.heapreplace(self._heap, (-hashed, value))
+            del self.counts[evicted]
+        else:
+            return
+        self.counts[value] = count
+
+    def merge(self, other):
+        """
+        Merges another sample into this one.
+        """
+        for value, count in other.counts.items():
+            self.add(value, count)
+        return self
+
+    def to_dict(self):
+        """
+        Returns a JSON-serializable representation of the sample.
+        """
+        return {'size': self.size, 'counts': self.counts}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Rebuilds a sample from the output of to_dict.
+        """
+        sample = cls(data['size'])
+        for value, count in data['counts'].items():
+            sample.add(value, count)
+        return sample
@@ -0,0 +1,114 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+# --- STAGE ARTIFACT CACHE ---
+# Stores the output of each analysis stage on disk under a key made from everything
+# the output depends on (a hash of the stage's input, the configuration values it
+# reads and the library versions), so a rerun only recomputes stages whose inputs
+# changed. The least recently used artifacts are deleted once the cache grows past
+# its size limit.
+
+ARTIFACT_SUFFIX = '.json.gz'
+# Eviction frees space down to this fraction of the size limit, so that a full
+# cache is not scanned again on every store
+EVICTION_TARGET = 0.9
+
+def make_key(stage, inputs):
+    """
+    Returns the cache key of a stage: a hash of its name and of inputs, a
+    JSON-serializable dict of everything the stage's output depends on.
+    """
+    description = json.dumps({'stage': stage, 'inputs': inputs}, sort_keys=True, ensure_ascii=False, default=str)
+    return stage + '-' + hashlib.blake2b(description.encode('utf-8'), digest_size=20).hexdigest()
+
+class StageCache:
+    """
+    A directory of gzipped JSON artifacts, one per stage output. A cache without a
+    directory is disabled and computes every stage.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = None # Total size of the artifacts, known after the first scan
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def run(self, stage, inputs, compute):
+        """
+        Returns the cached output of stage for these inputs, or computes it with
+        compute() and stores it. Outputs come back as they would from JSON.
+        """
+        if not self.directory:
+            return compute()
+
+        path = os.path.join(self.directory, make_key(stage, inputs) + ARTIFACT_SUFFIX)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                result = json.load(f)
+        except (OSError, EOFError, json.JSONDecodeError):
+            pass
+        else:
+            # The modification time marks when an artifact was last used
+            os.utime(path)
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        text = json.dumps(compute(), default=str)
+        self.store(path, text)
+        # Return what a later cache hit would, so both runs produce the same output
+        return json.loads(text)
+
+    def store(self, path, text):
+        """
+        Writes an artifact atomically, then evicts old artifacts if over the size limit.
+        The directory is only scanned when the running size total goes over the limit.
+        """
+        handle, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8') as f:
+                f.write(text)
+            added = os.path.getsize(temporary_path)
+            if os.path.exists(path):
+                added -= os.path.getsize(path)
+            os.replace(temporary_path, path)
+        except OSError as e:
+            print(f"WARNING: Could not write to the stage cache. Details: {e}")
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            return
+        if self.size is None or self.size + added > self.max_bytes:
+            self.evict()
+        else:
+            self.size += added
+
+    def evict(self):
+        """
+        Deletes the least recently used artifacts until the cache fits in max_bytes
+        (down to EVICTION_TARGET of it if over), and recounts the size total (other
+        processes may share the directory).
+        """
+        artifacts = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(ARTIFACT_SUFFIX):
+                stat = entry.stat()
+                artifacts.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        target = self.max_bytes if total <= self.max_bytes else self.max_bytes * EVICTION_TARGET
+        for _, size, path in sorted(artifacts):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue # Already evicted by another process
+            total -= size
+        self.size = total
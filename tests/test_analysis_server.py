@@ -0,0 +1,76 @@
+import json
+import os
+
+import pytest
+
+from analysis_server import analyze_request, find_malformed_message, is_dashboard_file, resolve_data_path
+
+VALID_MESSAGE = {
+    'sender_name': 'Alice',
+    'timestamp_ms': 1700000000000,
+    'content': 'hello',
+    'reactions': [{'actor': 'Bob', 'reaction': '❤'}],
+    'photos': [{'uri': 'photos/1.jpg'}]
+}
+
+MALFORMED_MESSAGES = [
+    'not an object',
+    {'timestamp_ms': 1700000000000},
+    {'sender_name': 'Alice'},
+    {'sender_name': 'Alice', 'timestamp_ms': '1700000000000'},
+    {'sender_name': 'Alice', 'timestamp_ms': True},
+    {'sender_name': 'Alice', 'timestamp_ms': 1700000000000, 'call_duration': '60'},
+    {'sender_name': 'Alice', 'timestamp_ms': 1700000000000, 'reactions': {'actor': 'Bob'}},
+    {'sender_name': 'Alice', 'timestamp_ms': 1700000000000, 'reactions': [1]},
+    {'sender_name': 'Alice', 'timestamp_ms': 1700000000000, 'reactions': [{'actor': 1, 'reaction': '❤'}]},
+    {'sender_name': 'Alice', 'timestamp_ms': 1700000000000, 'reactions': [{'actor': 'Bob', 'reaction': ['❤']}]},
+    {'sender_name': 'Alice', 'timestamp_ms': 1700000000000, 'photos': [{'uri': 7}]},
+    {'sender_name': 'Alice', 'timestamp_ms': 1700000000000, 'files': [{'uri': {'path': 'a.pdf'}}]}
+]
+
+def test_valid_messages_pass():
+    minimal = {'sender_name': 'Bob', 'timestamp_ms': 1700000001000}
+    assert find_malformed_message([VALID_MESSAGE, minimal]) is None
+
+@pytest.mark.parametrize('message', MALFORMED_MESSAGES)
+def test_malformed_upload_is_rejected(message):
+    body = json.dumps({'messages': [VALID_MESSAGE, message]}).encode('utf-8')
+    status, result = analyze_request(body, None)
+    assert status == 400
+    assert json.loads(result)['error'].startswith('Message 1 is malformed')
+
+@pytest.mark.parametrize('body', [b'{"foo": 1}', b'{"messages": {}}', b'"text"', b'not json'])
+def test_upload_without_message_list_is_rejected(body):
+    status, _ = analyze_request(body, None)
+    assert status == 400
+
+def test_only_dashboard_files_are_served(tmp_path):
+    for name in ['index.html', 'script.js', 'filtered_messages.json', 'run_advanced_analysis.py']:
+        (tmp_path / name).write_text('x')
+    (tmp_path / 'music').mkdir()
+    (tmp_path / 'music' / 'song.mp3').write_text('x')
+    (tmp_path / '.git').mkdir()
+    (tmp_path / '.git' / 'config').write_text('x')
+    os.symlink(tmp_path / 'filtered_messages.json', tmp_path / 'music' / 'export.mp3')
+
+    assert is_dashboard_file(tmp_path, tmp_path)
+    assert is_dashboard_file(tmp_path, tmp_path / 'script.js')
+    assert is_dashboard_file(tmp_path, tmp_path / 'music' / 'song.mp3')
+    assert not is_dashboard_file(tmp_path, tmp_path / 'filtered_messages.json')
+    assert not is_dashboard_file(tmp_path, tmp_path / 'run_advanced_analysis.py')
+    assert not is_dashboard_file(tmp_path, tmp_path / '.git' / 'config')
+    assert not is_dashboard_file(tmp_path, tmp_path / 'music')
+    assert not is_dashboard_file(tmp_path, tmp_path / 'style.css')
+    assert not is_dashboard_file(tmp_path / 'music', tmp_path / 'music' / 'export.mp3')
+
+def test_data_paths_stay_inside_the_data_dir(tmp_path):
+    data_dir = tmp_path / 'exports'
+    (data_dir / 'chat').mkdir(parents=True)
+    (tmp_path / 'secret.json').write_text('[]')
+    os.symlink(tmp_path / 'secret.json', data_dir / 'link.json')
+
+    assert resolve_data_path(data_dir, 'chat') == os.path.realpath(data_dir / 'chat')
+    assert resolve_data_path(data_dir, str(data_dir / 'chat')) == os.path.realpath(data_dir / 'chat')
+    assert resolve_data_path(data_dir, '../secret.json') is None
+    assert resolve_data_path(data_dir, str(tmp_path / 'secret.json')) is None
+    assert resolve_data_path(data_dir, 'link.json') is None
@@ -0,0 +1,52 @@
+import pytest
+
+import batch_sentiment
+from batch_sentiment import VERIFY_EXAMPLES, VERIFY_TOLERANCE, BatchSentimentScorer
+
+TEXTS = VERIFY_EXAMPLES + [
+    "I love this 😍😍 so much",
+    "ugh 😡 not again",
+    "this is not good at all",
+    "I don't hate it, it isn't bad",
+    "never so happy in my life",
+    "the food was great but the service was terrible",
+    "It was okay BUT the ending was AWFUL",
+    "This is AMAZING and I am SO HAPPY",
+    "ALL CAPS TEXT IS GREAT",
+    "the movie was kind of good",
+    "at least it was not boring",
+    "I am the least happy person here",
+    "what?!?! really??? no way!!!!",
+    "",
+    "   ",
+    "😂",
+    "hahaha lol 😂😂😂 you're the bomb"
+]
+
+@pytest.fixture(scope='module')
+def scorer():
+    return BatchSentimentScorer()
+
+def assert_matches_vader(scorer, texts, scores):
+    assert len(scores) == len(texts)
+    for text, score in zip(texts, scores):
+        expected = scorer.analyzer.polarity_scores(text)['compound']
+        assert abs(score - expected) <= VERIFY_TOLERANCE, text
+
+def test_batch_matches_vader(scorer):
+    assert_matches_vader(scorer, TEXTS, scorer.compound_scores(TEXTS))
+
+def test_single_texts_match_vader(scorer):
+    for text in TEXTS:
+        assert_matches_vader(scorer, [text], scorer.compound_scores([text]))
+
+def test_scores_match_after_table_reset(scorer, monkeypatch):
+    monkeypatch.setattr(batch_sentiment, 'MAX_TABLE_TOKENS', 20)
+    small = BatchSentimentScorer(scorer.analyzer)
+    resets = 0
+    for start in range(0, len(TEXTS), 3):
+        batch = TEXTS[start:start + 3]
+        before = len(small.token_ids)
+        assert_matches_vader(scorer, batch, small.compound_scores(batch))
+        resets += len(small.token_ids) < before
+    assert resets > 0
@@ -0,0 +1,254 @@
+import json
+import re
+import struct
+import zlib
+import argparse
+from collections import Counter
+from datetime import datetime
+
+from periods import PERIOD_FORMATS
+
+# --- CONFIGURATION ---
+
+INDEX_MAGIC = b'CHATIDX1'
+
+# --- ENCODING ---
+# Postings are stored as unsigned varints, delta-encoded where values only grow,
+# and each term's postings are zlib-compressed separately so a query only reads
+# and decompresses the terms it asks for.
+
+def encode_varints(values):
+    """
+    Encodes non-negative ints as LEB128 varints.
+    """
+    out = bytearray()
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+def decode_varints(data):
+    """
+    Decodes a byte string of LEB128 varints.
+    """
+    values = []
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = 0
+            shift = 0
+    return values
+
+def tokenize(content):
+    """
+    Splits a message into lowercase words, ignoring links (as get_word_frequency does,
+    but keeping stopwords so that phrases can be searched).
+    """
+    return re.findall(r'\b\w+\b', re.sub(r'http\S+', '', content.lower()))
+
+# --- BUILD ---
+
+def build_index(input_file, index_file):
+    """
+    Builds the on-disk inverted index of all text messages: for every word, the
+    messages using it with their sender, timestamp and word positions.
+    """
+    # Imported here so that queries do not load the NLP models the analysis needs
+    from run_advanced_analysis import load_messages, prepare_messages, remove_exact_duplicates
+
+    print(f"Building word index for '{input_file}'...")
+    messages = load_messages(input_file)
+    if messages is None:
+        return
+    messages, _ = remove_exact_duplicates(messages)
+    text_messages, _ = prepare_messages(messages)
+    # Message ids follow time order, so ids and timestamps in postings only grow
+    text_messages.sort(key=lambda x: x.timestamp_ms)
+
+    senders = sorted(set(msg.sender_name for msg in text_messages))
+    sender_ids = {name: i for i, name in enumerate(senders)}
+
+    # term -> flat list of (message id, sender id, timestamp, positions) postings
+    postings = {}
+    for message_id, msg in enumerate(text_messages):
+        positions = {}
+        for position, token in enumerate(tokenize(msg.content)):
+            positions.setdefault(token, []).append(position)
+        for token, token_positions in positions.items():
+            postings.setdefault(token, []).append((message_id, sender_ids[msg.sender_name], msg.timestamp_ms, token_positions))
+
+    blocks = []
+    terms = {}
+    offset = 0
+    for term in sorted(postings):
+        values = []
+        last_id = 0
+        last_timestamp = 0
+        for message_id, sender_id, timestamp, token_positions in postings[term]:
+            values.extend((message_id - last_id, sender_id, timestamp - last_timestamp, len(token_positions)))
+            last_position = 0
+            for position in token_positions:
+                values.append(position - last_position)
+                last_position = position
+            last_id, last_timestamp = message_id, timestamp
+        block = zlib.compress(encode_varints(values))
+        terms[term] = [offset, len(block), len(postings[term])]
+        blocks.append(block)
+        offset += len(block)
+
+    header = zlib.compress(json.dumps({
+        'senders': senders,
+        'message_count': len(text_messages),
+        'first_timestamp': text_messages[0].timestamp_ms if text_messages else None,
+        'last_timestamp': text_messages[-1].timestamp_ms if text_messages else None,
+        'terms': terms
+    }).encode('utf-8'))
+    with open(index_file, 'wb') as f:
+        f.write(INDEX_MAGIC)
+        f.write(struct.pack('>Q', len(header)))
+        f.write(header)
+        for block in blocks:
+            f.write(block)
+
+    print(f"Indexed {len(terms)} words from {len(text_messages)} messages into '{index_file}'.")
+
+# --- QUERY ---
+
+class WordIndex:
+    """
+    Read access to an index written by build_index. Only the header is loaded when
+    the index is opened; the postings of a word are read from disk when it is queried.
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        with open(index_file, 'rb') as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError(f"'{index_file}' is not a word index.")
+            header_size = struct.unpack('>Q', f.read(8))[0]
+            header = json.loads(zlib.decompress(f.read(header_size)))
+        self.postings_start = len(INDEX_MAGIC) + 8 + header_size
+        self.senders = header['senders']
+        self.message_count = header['message_count']
+        self.terms = header['terms']
+
+    def postings(self, term):
+        """
+        Returns the postings of one word as (message id, sender, timestamp_ms, positions) tuples.
+        """
+        entry = self.terms.get(term)
+        if entry is None:
+            return []
+        offset, size, _ = entry
+        with open(self.index_file, 'rb') as f:
+            f.seek(self.postings_start + offset)
+            values = decode_varints(zlib.decompress(f.read(size)))
+
+        result = []
+        message_id = 0
+        timestamp = 0
+        i = 0
+        while i < len(values):
+            message_id += values[i]
+            sender_id = values[i + 1]
+            timestamp += values[i + 2]
+            count = values[i + 3]
+            i += 4
+            positions = []
+            position = 0
+            for delta in values[i:i + count]:
+                position += delta
+                positions.append(position)
+            i += count
+            result.append((message_id, self.senders[sender_id], timestamp, positions))
+        return result
+
+    def lookup(self, query):
+        """
+        Returns (message id, sender, timestamp_ms, occurrences) for every message that
+        uses the word or phrase, in time order.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        if len(tokens) == 1:
+            return [(message_id, sender, timestamp, len(positions)) for message_id, sender, timestamp, positions in self.postings(tokens[0])]
+
+        # Phrase: intersect the postings of each word, rarest first, then check positions
+        rarest_first = sorted(set(tokens), key=lambda token: self.terms.get(token, [0, 0, 0])[2])
+        by_token = {}
+        candidates = None
+        for token in rarest_first:
+            by_token[token] = {posting[0]: posting for posting in self.postings(token) if candidates is None or posting[0] in candidates}
+            candidates = set(by_token[token])
+            if not candidates:
+                return []
+
+        matches = []
+        for message_id in sorted(candidates):
+            _, sender, timestamp, first_positions = by_token[tokens[0]][message_id]
+            position_sets = [set(by_token[token][message_id][3]) for token in tokens]
+            occurrences = sum(1 for start in first_positions if all(start + k in position_sets[k] for k in range(1, len(tokens))))
+            if occurrences:
+                matches.append((message_id, sender, timestamp, occurrences))
+        return matches
+
+    def query(self, query, by=None):
+        """
+        Answers a word or phrase query: total uses, messages, first and last use, and
+        optionally a breakdown by 'sender', 'day', 'month' or 'year'.
+        """
+        matches = self.lookup(query)
+        result = {
+            'query': query,
+            'count': sum(occurrences for _, _, _, occurrences in matches),
+            'message_count': len(matches),
+            'first_use': None,
+            'last_use': None
+        }
+        if matches:
+            for key, (message_id, sender, timestamp, occurrences) in (('first_use', matches[0]), ('last_use', matches[-1])):
+                result[key] = {'sender': sender, 'time': datetime.fromtimestamp(timestamp / 1000).strftime('%Y-%m-%d %H:%M:%S')}
+
+        if by == 'sender':
+            breakdown = Counter()
+            for _, sender, _, occurrences in matches:
+                breakdown[sender] += occurrences
+            result['by_sender'] = breakdown.most_common()
+        elif by in PERIOD_FORMATS:
+            breakdown = Counter()
+            for _, _, timestamp, occurrences in matches:
+                breakdown[datetime.fromtimestamp(timestamp / 1000).strftime(PERIOD_FORMATS[by])] += occurrences
+            result[f'by_{by}'] = sorted(breakdown.items())
+        return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and query an inverted index of the words used in the chat.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Build the word index')
+    build_parser.add_argument('-i', '--input', default='filtered_messages.json', help='Input JSON file or export folder (default: filtered_messages.json)')
+    build_parser.add_argument('-o', '--output', default='word_index.bin', help='Index file to write (default: word_index.bin)')
+
+    query_parser = subparsers.add_parser('query', help='Query the word index')
+    query_parser.add_argument('words', nargs='+', help='Words or phrases to look up, e.g. rizz "fanum tax"')
+    query_parser.add_argument('--index', default='word_index.bin', help='Index file to read (default: word_index.bin)')
+    query_parser.add_argument('--by', choices=['sender'] + list(PERIOD_FORMATS), help='Break the counts down by sender or period')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_index(args.input, args.output)
+    else:
+        try:
+            index = WordIndex(args.index)
+        except (FileNotFoundError, ValueError) as e:
+            print(f"ERROR: Could not open the word index. Build it first with 'build'. Details: {e}")
+        else:
+            print(json.dumps([index.query(words, args.by) for words in args.words], indent=4, ensure_ascii=False))